@@ -13,18 +13,27 @@
 ###############################################################################
 
 from typing import Dict, List
-from xarray import DataArray
 from pandas import DataFrame
 import datetime as dt
+import numpy as np
+import tempfile
 import time
+import os
 
-from common import RINEX_FOLDER, POS_DATA_FOLDER, CHN_UTC
+from common import RINEX_FOLDER, POS_DATA_FOLDER, CHN_UTC, CHN_LAT, CHN_LON, CHN_TYPES
 from reader_rinex import OrbitalData
 from reader_pos_data import PosData
 from fov_models import FOV_model, FOV_view_match
 from calcs import Calc, Calc_gdop
+from geometry import SatGeometry
 from d_print import Debug, Info
 
+# Ways of picking the position data at every sampling time:
+# - "first":   first row at or after the sampling time
+# - "nearest": row closest in time to the sampling time
+# - "mean":    average of the rows in [sampling time, sampling time + Ts)
+SAMPLING_STRATEGIES = ("first", "nearest", "mean")
+
 
 class Calc_manager:
     def __init__(
@@ -35,9 +44,23 @@ class Calc_manager:
         data_folder=POS_DATA_FOLDER,
         out_folder=POS_DATA_FOLDER,
         ts=5,
+        typed=True,
+        chunk_rows=0,
+        cache=True,
+        utc_range=None,
+        sampling="first",
+        subsecond=True,
+        orbit_fit=False,
+        position_cube=False,
+        ephemeris_source=None,
     ):
-        # Sampling period
+        # Sampling period and strategy. Periods can be fractional, 0 samples every row
+        if ts < 0:
+            raise Exception(f"The sampling period cannot be negative ({ts}).")
         self.Ts = dt.timedelta(seconds=ts)
+        if sampling not in SAMPLING_STRATEGIES:
+            raise Exception(f"Sampling must be one of {SAMPLING_STRATEGIES}, not '{sampling}'.")
+        self.sampling = sampling
 
         # Directories
         self.rinex_dir = rinex_folder
@@ -46,18 +69,43 @@ class Calc_manager:
 
         # File names
         self.input_file = in_file
-        self.output_file = in_file[:-4] + "_gdoper.csv" if out_file == "" else out_file
+        self.output_file = (
+            os.path.splitext(in_file)[0] + "_gdoper.csv" if out_file == "" else out_file
+        )
 
         # Objects
-        self.pos_obj = PosData(str(self.pdata_dir) + self.input_file)
-        self.sat_obj = OrbitalData()
+        # If chunk_rows > 0 the positions are streamed in blocks of that many rows.
+        # If cache, typed positions are mapped from a binary sidecar of the file.
+        # utc_range (start, end) limits the processing to a time window.
+        # If subsecond, typed UTC times are rebuilt with the millisecond column.
+        self.pos_obj = PosData(
+            str(self.pdata_dir) + self.input_file,
+            typed=typed,
+            chunk_rows=chunk_rows,
+            cache=cache,
+            utc_range=utc_range,
+            subsecond=subsecond,
+        )
+        # If orbit_fit, the satellite orbits are fitted with Chebyshev polynomials.
+        # If position_cube, satellite positions are read from a cached cube of the day.
+        # Missing RINEX files are downloaded from ephemeris_source (Earthscope if None).
+        self.sat_obj = OrbitalData(source=ephemeris_source)
+        self.orbit_fit = orbit_fit
+        self.position_cube = position_cube
         self.fov_obj = FOV_model()  # real obj created in setup_FOV()
         self.calcs_q: List[Calc] = []  # A queue for calculations
         self.req_vars = set()  # The variables required by FOV_model and Calc
 
-        # Processed data
+        # Processed data (of the block being processed)
         self.output_map: Dict[str, list] = {}
         self.ordered_keys: List[str] = []
+        self.output_rows = 0
+
+        # Sampling state kept between blocks: next sampling time and the rows
+        # of the previous block that can still be part of a sample
+        self.next_sample: np.datetime64 = None
+        self.carry: Dict[str, np.ndarray] = {}
+        self.carry_sampled = False
 
     def set_FOV(self, model: FOV_model) -> None:
         """
@@ -97,49 +145,143 @@ class Calc_manager:
                         Select an inherited class."
                 )
             else:
-                self.req_vars.union(set(i.required_vars()))
+                self.req_vars = self.req_vars.union(set(i.required_vars()))
 
         self.req_vars = self.req_vars.union(set(self.fov_obj.required_vars()))
 
         # Have readers check for existance of their files and folders
-        self.pos_obj.setup()
+        self.pos_obj.setup(columns=self.req_vars)
+        if {CHN_LAT, CHN_LON} <= self.req_vars:
+            # The RINEX file is downloaded from the stations nearest to the start
+            self.sat_obj.set_location(*self.pos_obj.get_first_position())
         self.sat_obj.setup(self.pos_obj.get_first_utc())
+        if self.orbit_fit:
+            self.sat_obj.precompute_orbits()
+        if self.position_cube:
+            self.sat_obj.use_position_cube()
 
-    def __sample_pos(self) -> Dict[str, list]:
+        self.next_sample = np.datetime64(self.pos_obj.get_first_utc(), "us")
+        self.carry = {}
+        self.carry_sampled = False
+        self.output_rows = 0
+
+    def __pos_blocks(self):
         """
-        Get the position data from file and return a sampled version
+        Return an iterable of the position data blocks to process.\n
+        The whole file is a single block unless it is being streamed.
         """
-        # Get pos data
-        all_pos = self.pos_obj.get_merged_cols(list(self.req_vars))
-        all_pos_row_count = self.pos_obj.row_count
-        chn_keys = list(all_pos.keys())
-        sampled = {}
+        if self.pos_obj.chunk_rows > 0:
+            return self.pos_obj.iter_chunks()
+        return [self.pos_obj.get_merged_cols(list(self.req_vars))]
+
+    def __sample_pos(self, block: dict, final: bool = False) -> Dict[str, list]:
+        """
+        Return a sampled version of a block of position data.\n
+        Sampling times are every Ts from the first UTC of the data, and
+        continue from the previous block. 'final' marks the end of the data,
+        so samples still waiting for more rows (in "mean") are output.
+        The times stay datetime64 until the output is written.
+        """
+        if block is None:
+            block = {chn: col[:0] for chn, col in self.carry.items()}
+
+        # Get pos data as arrays, after the rows carried from the previous block
+        all_pos = {}
+        for chn in self.req_vars:
+            col = np.asarray(block[chn])
+            if chn in CHN_TYPES:  # Parse the known columns of untyped data only once
+                col = col.astype(CHN_TYPES[chn], copy=False)
+            if chn in self.carry:
+                col = np.concatenate((self.carry[chn], col))
+            all_pos[chn] = col
+
+        times = all_pos[CHN_UTC]
+        dif = np.timedelta64(self.Ts)
+
+        if dif == np.timedelta64(0):
+            # Full rate, every row is a sample
+            return dict(all_pos)
+
+        # Sampling times up to the last row (so all have a row at or after them)
+        n = 0
+        if len(times) > 0 and times[-1] >= self.next_sample:
+            n = int((times[-1] - self.next_sample) // dif) + 1
+        grid = self.next_sample + dif * np.arange(n)
+        self.next_sample = self.next_sample + dif * n
+
+        if self.sampling == "mean":
+            sampled = self.__sample_mean(all_pos, grid, dif, final)
+        else:
+            sampled = self.__sample_rows(all_pos, grid)
 
-        # Setup empty lists for each CHN
-        for i in chn_keys:
-            sampled[i] = []
+        return sampled
+
+    def __sample_rows(self, all_pos: dict, grid: np.ndarray) -> dict:
+        """
+        Return the rows picked for every sampling time ("first" or "nearest").\n
+        A row is only picked once, even if it is the pick of several sampling
+        times (after a gap in the data).
+        """
+        times = all_pos[CHN_UTC]
+        carried = len(self.carry) > 0
 
-        # Sample
-        dif = dt.timedelta(seconds=self.Ts.seconds)
-        last_saved = dt.datetime.fromisoformat(self.pos_obj.get_first_utc()) - dif
+        idx = np.searchsorted(times, grid, side="left")
+        if self.sampling == "nearest" and len(idx) > 0:
+            # The row before can be closer, it may be the one carried over
+            before = np.maximum(idx - 1, 0)
+            closer = (idx > 0) & ((grid - times[before]) <= (times[idx] - grid))
+            idx = np.where(closer, before, idx)
 
-        for i in range(all_pos_row_count):
-            t = dt.datetime.fromisoformat(all_pos[CHN_UTC][i])  # TODO: use proper name for utc
+        idx = np.unique(idx)
+        if carried and self.carry_sampled:
+            idx = idx[idx > 0]
 
-            if t - last_saved >= dif:
-                # Add samples from this index
-                for chn in chn_keys:
-                    sampled[chn].append(all_pos[chn][i])
+        if self.sampling == "nearest" and len(times) > 0:
+            # The last row can be the closest one to the next sampling time
+            self.carry = {chn: col[-1:] for chn, col in all_pos.items()}
+            self.carry_sampled = len(idx) > 0 and idx[-1] == len(times) - 1
 
-                last_saved = last_saved + dif
+        return {chn: col[idx] for chn, col in all_pos.items()}
+
+    def __sample_mean(self, all_pos: dict, grid: np.ndarray, dif, final: bool) -> dict:
+        """
+        Return the mean of the rows in the window after every sampling time.
+        Float columns are averaged, other columns take the first row of the
+        window, and the time is the sampling time.\n
+        Rows of a window that may continue in the next block are carried over.
+        """
+        times = all_pos[CHN_UTC]
+
+        # Windows [grid, grid + dif), the last one is complete if there are rows after it
+        start = np.searchsorted(times, grid, side="left")
+        end = np.searchsorted(times, grid + dif, side="left")
+
+        self.carry = {}
+        if not final and len(grid) > 0 and end[-1] == len(times):
+            self.carry = {chn: col[start[-1] :] for chn, col in all_pos.items()}
+            self.next_sample = grid[-1]  # The carried window is sampled again
+            grid, start, end = grid[:-1], start[:-1], end[:-1]
+
+        full = start < end
+        grid, start, end = grid[full], start[full], end[full]
+
+        sampled = {}
+        for chn, col in all_pos.items():
+            if chn == CHN_UTC:
+                sampled[chn] = grid
+            elif col.dtype.kind == "f" and len(start) > 0:
+                # Non empty windows are contiguous, each one ends where the next starts
+                sampled[chn] = np.add.reduceat(col[: end[-1]], start) / (end - start)
+            else:
+                sampled[chn] = col[start]
 
         return sampled
 
-    def __acquire_sats(self, pos_timestamps) -> Dict[str, DataArray]:
+    def __acquire_sats(self, pos_timestamps) -> SatGeometry:
         """
         Return all satellites for all pos in time
         """
-        return self.sat_obj.get_sats_pos(pos_timestamps)
+        return self.sat_obj.get_sats_geometry(pos_timestamps)
 
     def __sats_in_fov(self, pos_pos, sats_pos):
         """
@@ -177,26 +319,31 @@ class Calc_manager:
     def __output_to_file(self):
         """
         Writes all data in self.output_map to a file in csv format.\n
-        File name is "self.out_dir + self.output_file"
+        File name is "self.out_dir + self.output_file". The first block
+        creates the file, the following ones are appended to it.
         """
 
         fn = str(self.out_dir) + self.output_file
-        DataFrame(self.output_map).to_csv(fn, index=False)
+        first = self.output_rows == 0
+        output = dict(self.output_map)
+        if CHN_UTC in output:
+            output[CHN_UTC] = utc_strings(output[CHN_UTC])
+        DataFrame(output).to_csv(fn, index=False, mode="w" if first else "a", header=first)
 
-    def process_data(self):
+    def __process_block(self, block: dict, timing: Dict[str, float], final: bool = False):
         """
-        Acquire relevant data, process, and output into csv format
+        Sample, process and output a block of position data.\n
+        Time spent on every step is added to 'timing'.
         """
-        tot = time.perf_counter()
-        now = time.perf_counter()
-        Debug(f"Setting up...")
-        self.__setup()
-        Debug(f"Done. {time.perf_counter()-now:.3f}s\n")
+        self.output_map = {}
+        self.ordered_keys = []
 
         now = time.perf_counter()
-        Debug(f"Sampling positions...")
-        pos = self.__sample_pos()
-        Debug(f"Done. {time.perf_counter()-now:.3f}s\n")
+        pos = self.__sample_pos(block, final)
+        timing["Sampling positions"] += time.perf_counter() - now
+
+        if len(pos[CHN_UTC]) == 0:
+            return
 
         # Add data used for calculation to output file
         for k in list(pos.keys()):
@@ -204,31 +351,76 @@ class Calc_manager:
                 self.__add_to_output_map(k, pos[k])
 
         now = time.perf_counter()
-        Debug(f"Aquiring satellite info...")
         all_sats = self.__acquire_sats(pos[CHN_UTC])  # TODO: make CHNs more flexible
-        # Debug(f'Done. {time.perf_counter()-now:.3f}s\n')
+        timing["Aquiring satellite info"] += time.perf_counter() - now
 
         now = time.perf_counter()
-        Debug(f"Calculating visible satellites...")
         los_sats = self.__sats_in_fov(pos, all_sats)
-        Debug(f"Done. {time.perf_counter()-now:.3f}s\n")
+        timing["Calculating visible satellites"] += time.perf_counter() - now
 
         now = time.perf_counter()
-        Debug(f"Performing calculations...")
         self.__do_calcs(pos, los_sats)
-        Debug(f"Done. {time.perf_counter()-now:.3f}s\n")
+        timing["Performing calculations"] += time.perf_counter() - now
 
         now = time.perf_counter()
-        Debug(f"Writing to file...")
         self.__output_to_file()
+        timing["Writing to file"] += time.perf_counter() - now
+
+        self.output_rows += len(pos[CHN_UTC])
+
+    def process_data(self):
+        """
+        Acquire relevant data, process, and output into csv format.\n
+        Positions are processed block by block, so when they are streamed
+        (chunk_rows > 0) memory use doesn't grow with the file.
+        """
+        tot = time.perf_counter()
+        now = time.perf_counter()
+        Debug(f"Setting up...")
+        self.__setup()
         Debug(f"Done. {time.perf_counter()-now:.3f}s\n")
 
+        timing = {
+            "Sampling positions": 0.0,
+            "Aquiring satellite info": 0.0,
+            "Calculating visible satellites": 0.0,
+            "Performing calculations": 0.0,
+            "Writing to file": 0.0,
+        }
+
+        blocks = 0
+        for block in self.__pos_blocks():
+            self.__process_block(block, timing)
+            blocks += 1
+
+        if self.sampling == "mean" and len(self.carry) > 0:
+            # Output the samples of the rows carried after the last block
+            self.__process_block(None, timing, final=True)
+
+        for step, t in timing.items():
+            Debug(f"{step}: {t:.3f}s")
+
         Debug(
             f"Total runtime: {time.perf_counter() - tot:.3f}"
-            + f" for {len(self.output_map[self.ordered_keys[0]])} output rows"
+            + f" for {self.output_rows} output rows ({blocks} blocks)"
         )
 
 
+def utc_strings(times: np.ndarray) -> np.ndarray:
+    """
+    Return the times formatted like datetime.isoformat(sep=" "): with the
+    microseconds only when they aren't zero
+    """
+    times = np.asarray(times, dtype="datetime64[us]")
+    if len(times) == 0:
+        return times.astype(str)
+    whole = times == times.astype("datetime64[s]")
+    text = np.where(
+        whole, np.datetime_as_string(times, unit="s"), np.datetime_as_string(times, unit="us")
+    )
+    return np.char.replace(text, "T", " ")
+
+
 def test():
     drone_data = "/test_data_full.csv"
     # output = '/test_data/test_data-gdop.csv'
@@ -239,7 +431,37 @@ def test():
     gdoper.process_data()
 
 
+def test_sampling(ts: float = 2, chunk_rows=(7, 100, 1000)):
+    """
+    Check that every sampling strategy gives the same output when the
+    positions are streamed in blocks of any size as when they are loaded
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        for sampling in SAMPLING_STRATEGIES:
+            outputs = {}
+            for rows in (0,) + tuple(chunk_rows):
+                gdoper = Calc_manager(
+                    "/test_data_full.csv",
+                    out_file="/out.csv",
+                    out_folder=out_dir,
+                    ts=ts,
+                    chunk_rows=rows,
+                    cache=False,
+                    sampling=sampling,
+                )
+                gdoper.set_FOV(FOV_view_match())
+                gdoper.add_calc(Calc_gdop())
+                gdoper.process_data()
+                with open(out_dir + "/out.csv", "r") as file:
+                    outputs[rows] = file.read()
+
+            for rows, output in outputs.items():
+                assert output == outputs[0], f'"{sampling}" differs in blocks of {rows} rows'
+            Info(f'"{sampling}": same output in blocks of {chunk_rows} rows')
+
+
 if __name__ == "__main__":
     test()
+    test_sampling()
     print("Done running")
     pass
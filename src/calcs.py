@@ -3,6 +3,7 @@
 from typing import Tuple, List
 import numpy as np
 from common import *
+from geometry import SatGeometry
 
 
 class Calc:
@@ -17,7 +18,7 @@ class Calc:
         pass
 
     def do_calc(self, sampled_pos, sats_FOV) -> Tuple[str, list]:
-        # Expected sats_FOV heirarchy is:  time{} -> prn{} -> (x,y,z)
+        # Expected sats_FOV is a SatGeometry with the rows of sampled_pos
         # Expected sampled_pos order is :  chn{} -> data[]
         pass
 
@@ -34,38 +35,49 @@ class Calc_gdop(Calc):
         return [CHN_UTC, CHN_LAT, CHN_LON, CHN_ALT]
 
     def do_calc(self, pos_pos, sats_FOV) -> Tuple[str, list]:
-        # sats_FOV is ordered like:  times{} -> prn{} = (x,y,z)
-
-        results = {"HDOP": [], "VDOP": [], "GDOP": []}
-
-        for i in range(len(pos_pos[CHN_UTC])):
-            t = pos_pos[CHN_UTC][i]
-
-            lat = pos_pos[CHN_LAT][i]
-            lon = pos_pos[CHN_LON][i]
-            alt = pos_pos[CHN_ALT][i]
-
-            u = np.array(lla2ecef(lat, lon, alt))
-
-            mat: np.array = []
-
-            # Add visible satellites to LOS matrix
-            for j in sats_FOV[t]:
-                sat_pos = sats_FOV[t][j]  # tuple, ECEF coord of a sat
-                d = lambda ax: sat_pos[ax] - u[ax]  # float, axis value difference (x=0, y=1, z=2)
-                psd = np.sqrt(
-                    d(0) ** 2 + d(1) ** 2 + d(2) ** 2
-                )  # pseudo range from receiver to sat
-                m_row = [-d(0) / psd, -d(1) / psd, -d(2) / psd, 1]  # Row in GDOP matrix
-                mat.append(m_row)
-
-            m = np.matmul(np.transpose(mat), mat)
-            Q = np.linalg.inv(m)
-            T = [Q[0][0], Q[1][1], Q[2][2], Q[3][3]]
-            hdop = np.sqrt(T[0] ** 2 + T[1] ** 2)
-
-            results["HDOP"].append(hdop)
-            results["VDOP"].append(T[2])
-            results["GDOP"].append(np.sqrt(np.trace(Q)))
-
-        return results
+        # sats_FOV is a SatGeometry, or a dict ordered like:  times{} -> prn{} = (x,y,z)
+        if not isinstance(sats_FOV, SatGeometry):
+            sats_FOV = SatGeometry.from_dict(sats_FOV, pos_pos[CHN_UTC])
+
+        # Receiver positions for all rows at once
+        rx_lla = np.column_stack(
+            (
+                np.asarray(pos_pos[CHN_LAT], dtype=np.float64),
+                np.asarray(pos_pos[CHN_LON], dtype=np.float64),
+                np.asarray(pos_pos[CHN_ALT], dtype=np.float64),
+            )
+        )
+        rx_ecef = lla2ecef_array(rx_lla[:, 0], rx_lla[:, 1], rx_lla[:, 2])
+
+        # Visible satellites as an (N,S,3) cube over all PRNs, NaN where not visible
+        cube = np.where(sats_FOV.visible[..., None], sats_FOV.xyz, np.nan)
+
+        # Local East, North, Up line of sight unit vectors of every pair
+        enu = ecef2enu(rx_ecef, cube, rx_lla)
+        visible = ~np.isnan(enu[..., 0])
+        los = enu / np.linalg.norm(enu, axis=2, keepdims=True)
+
+        # Rows of the GDOP matrix are [-e, -n, -u, 1], zero for hidden satellites
+        mat = np.concatenate((-los, np.ones(visible.shape + (1,))), axis=2)
+        mat[~visible] = 0
+
+        return dops(np.einsum("nsi,nsj->nij", mat, mat))
+
+
+def dops(m: np.ndarray) -> dict:
+    """
+    Return the HDOP, VDOP and GDOP lists from a stack of (4,4) normal
+    matrices (G^T G) in the local ENU frame.\n
+    DOPs are NaN where less than 4 satellites make the matrix singular.
+    """
+    singular = np.linalg.matrix_rank(m) < 4
+    m[singular] = np.eye(4)
+
+    Q = np.linalg.inv(m)
+    Q[singular] = np.nan
+
+    return {
+        "HDOP": np.sqrt(Q[:, 0, 0] + Q[:, 1, 1]).tolist(),
+        "VDOP": np.sqrt(Q[:, 2, 2]).tolist(),
+        "GDOP": np.sqrt(np.trace(Q, axis1=1, axis2=2)).tolist(),
+    }
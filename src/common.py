@@ -1,11 +1,16 @@
 from pyproj.transformer import Transformer
+from functools import lru_cache
 from pathlib import Path
 import datetime as d
+import numpy as np
+import hashlib
+import time
 import os
 
 __all__ = (
     "BASE_FOLDER",
     "RINEX_FOLDER",
+    "NAV_CACHE_DIR",
     "POS_DATA_FOLDER",
     "CHN_LAT",
     "CHN_LON",
@@ -13,9 +18,23 @@ __all__ = (
     "CHN_ALT",
     "CHN_UTC",
     "CHN_SAT",
+    "CHN_MS",
     "CHN_DEFAULTS",
+    "CHN_TYPES",
     "GDOP_INTERVAL",
+    "file_hash",
     "lla2ecef",
+    "lla2ecef_array",
+    "get_transformer",
+    "geodetic2ecef",
+    "ecef2geodetic",
+    "ecef2enu",
+    "ecef2aer",
+    "WGS84_A",
+    "WGS84_F",
+    "WGS84_B",
+    "WGS84_E2",
+    "WGS84_EP2",
     "LOS_ANGLE",
     "GDOP_ALL",
     "GDOP_ONLY",
@@ -23,13 +42,19 @@ __all__ = (
 
 BASE_FOLDER = Path(__file__).resolve().parent.parent
 RINEX_FOLDER = Path(BASE_FOLDER / "rinex_files")
+# Files derived from the RINEX files (parsed NAV data, positions, catalog)
+NAV_CACHE_DIR = Path(RINEX_FOLDER / ".nav_cache")
 POS_DATA_FOLDER = Path(BASE_FOLDER / "test_data")
 
 if not os.path.isdir(RINEX_FOLDER):
     os.mkdir(RINEX_FOLDER)
 
 # WGS84 constants
-# TODO: put them here?
+WGS84_A = 6378137.0  # Semi-major axis (m)
+WGS84_F = 1 / 298.257223563  # Flattening
+WGS84_B = WGS84_A * (1 - WGS84_F)  # Semi-minor axis (m)
+WGS84_E2 = WGS84_F * (2 - WGS84_F)  # First eccentricity squared
+WGS84_EP2 = WGS84_E2 / (1 - WGS84_E2)  # Second eccentricity squared
 
 
 # Column header names as written in the postioning data csv files
@@ -38,9 +63,20 @@ CHN_LON = "longitude"
 CHN_ALT = "altitude_above_seaLevel(meters)"
 CHN_UTC = "datetime(utc)"
 CHN_SAT = "satellites"
+CHN_MS = "time(millisecond)"  # Milliseconds since the logger started
 
 CHN_DEFAULTS = (CHN_LON, CHN_LAT, CHN_ALT, CHN_UTC, CHN_SAT)
 
+# Types of the known columns when positioning data is read in typed mode
+CHN_TYPES = {
+    CHN_LAT: np.float64,
+    CHN_LON: np.float64,
+    CHN_ALT: np.float64,
+    CHN_UTC: "datetime64[ms]",  # UTC, numpy datetimes are timezone naive
+    CHN_SAT: np.uint8,
+    CHN_MS: np.float64,
+}
+
 
 # Time intervals for which to calculate GDOP
 GDOP_INTERVAL = d.timedelta(seconds=2)
@@ -57,8 +93,238 @@ LOS_ANGLE = 5
 # Functions
 
 
+def file_hash(filename, block_size: int = 1 << 20) -> str:
+    """
+    Return the BLAKE2b hex digest of the contents of a file
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_transformer(crs_from: str = "epsg:4979", crs_to: str = "epsg:4978") -> Transformer:
+    """
+    Return a Transformer between two CRSs.\n
+    Building a Transformer is expensive, so one instance is kept per CRS pair.
+    """
+    return Transformer.from_crs(crs_from, crs_to)
+
+
 def lla2ecef(lat, lon, alt) -> tuple:
     # https://epsg.io/4978 and http://epsg.io/4979
     # WGS84 lat,lon,alt    and WGS84 ECEF
-    t = Transformer.from_crs("epsg:4979", "epsg:4978")
+    t = get_transformer("epsg:4979", "epsg:4978")
     return t.transform(lat, lon, alt)
+
+
+def lla2ecef_array(lat, lon, alt, crs_from="epsg:4979", crs_to="epsg:4978") -> np.ndarray:
+    """
+    Convert whole columns of lat, lon, alt into ECEF coordinates in one call.\n
+    Inputs can be any sequence convertible to float (including the strings
+    read from the csv files). Returns an array with shape (N,3).
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    alt = np.asarray(alt, dtype=np.float64)
+
+    t = get_transformer(crs_from, crs_to)
+    x, y, z = t.transform(lat, lon, alt)
+
+    return np.column_stack((x, y, z))
+
+
+def geodetic2ecef(lat, lon, alt) -> np.ndarray:
+    """
+    Closed form WGS84 geodetic (degrees, meters) to ECEF conversion.\n
+    Same result as lla2ecef_array without going through pyproj.
+    Inputs broadcast against each other, the output has shape (...,3).
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    alt = np.asarray(alt, dtype=np.float64)
+
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+
+    # Prime vertical radius of curvature
+    n = WGS84_A / np.sqrt(1 - WGS84_E2 * sin_lat**2)
+
+    x = (n + alt) * cos_lat * np.cos(lon)
+    y = (n + alt) * cos_lat * np.sin(lon)
+    z = (n * (1 - WGS84_E2) + alt) * sin_lat
+
+    return np.stack(np.broadcast_arrays(x, y, z), axis=-1)
+
+
+def ecef2geodetic(xyz) -> np.ndarray:
+    """
+    Closed form (Heikkinen) WGS84 ECEF to geodetic conversion.\n
+    Input has shape (...,3), the output has the same shape with
+    columns lat, lon (degrees) and alt (meters).
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    x = xyz[..., 0]
+    y = xyz[..., 1]
+    z = xyz[..., 2]
+
+    a = WGS84_A
+    b = WGS84_B
+    e2 = WGS84_E2
+
+    z2 = z**2
+    p2 = x**2 + y**2
+    p = np.sqrt(p2)
+
+    f = 54 * b**2 * z2
+    g = p2 + (1 - e2) * z2 - e2 * (a**2 - b**2)
+    c = e2**2 * f * p2 / g**3
+    s = np.cbrt(1 + c + np.sqrt(c**2 + 2 * c))
+    k = s + 1 + 1 / s
+    pp = f / (3 * k**2 * g**2)
+    q = np.sqrt(1 + 2 * e2**2 * pp)
+    r0 = -(pp * e2 * p) / (1 + q) + np.sqrt(
+        np.maximum(
+            a**2 / 2 * (1 + 1 / q) - pp * (1 - e2) * z2 / (q * (1 + q)) - pp * p2 / 2,
+            0,
+        )
+    )
+    u = np.sqrt((p - e2 * r0) ** 2 + z2)
+    v = np.sqrt((p - e2 * r0) ** 2 + (1 - e2) * z2)
+    z0 = b**2 * z / (a * v)
+
+    alt = u * (1 - b**2 / (a * v))
+    lat = np.degrees(np.arctan2(z + WGS84_EP2 * z0, p))
+    lon = np.degrees(np.arctan2(y, x))
+
+    return np.stack((lat, lon, alt), axis=-1)
+
+
+def ecef2enu(rx_ecef, sat_ecef, rx_lla=None) -> np.ndarray:
+    """
+    Rotate the receiver to satellite vectors into the local East, North, Up
+    frame of every receiver.\n
+    rx_ecef has shape (N,3) and sat_ecef (N,S,3), the output is (N,S,3).
+    rx_lla (N,3) can be given to skip the conversion of rx_ecef to geodetic.
+    """
+    rx_ecef = np.asarray(rx_ecef, dtype=np.float64)
+    sat_ecef = np.asarray(sat_ecef, dtype=np.float64)
+    if rx_lla is None:
+        rx_lla = ecef2geodetic(rx_ecef)
+    else:
+        rx_lla = np.asarray(rx_lla, dtype=np.float64)
+
+    lat = np.radians(rx_lla[..., 0])
+    lon = np.radians(rx_lla[..., 1])
+    sin_lat, cos_lat = np.sin(lat), np.cos(lat)
+    sin_lon, cos_lon = np.sin(lon), np.cos(lon)
+
+    # ECEF -> ENU rotation matrix of every receiver, shape (N,3,3)
+    rot = np.stack(
+        (
+            np.stack((-sin_lon, cos_lon, np.zeros_like(lat)), axis=-1),
+            np.stack((-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat), axis=-1),
+            np.stack((cos_lat * cos_lon, cos_lat * sin_lon, sin_lat), axis=-1),
+        ),
+        axis=-2,
+    )
+
+    los = sat_ecef - rx_ecef[..., np.newaxis, :]
+    return np.einsum("...ij,...sj->...si", rot, los)
+
+
+def ecef2aer(rx_ecef, sat_ecef, rx_lla=None) -> tuple:
+    """
+    Return the azimuth (degrees from north, clockwise), elevation (degrees)
+    and range (meters) from every receiver to every satellite.\n
+    rx_ecef has shape (N,3) and sat_ecef (N,S,3), each output is (N,S).
+    """
+    enu = ecef2enu(rx_ecef, sat_ecef, rx_lla)
+    e = enu[..., 0]
+    n = enu[..., 1]
+    u = enu[..., 2]
+
+    hor = np.hypot(e, n)
+    az = np.degrees(np.arctan2(e, n)) % 360
+    el = np.degrees(np.arctan2(u, hor))
+    rng = np.hypot(hor, u)
+
+    return az, el, rng
+
+
+def check_wgs84(step: float = 2.5, tol: float = 1e-3) -> bool:
+    """
+    Self-check of geodetic2ecef and ecef2geodetic against pyproj
+    on a global grid (every 'step' degrees, several altitudes).\n
+    Returns True if every point agrees within 'tol' meters.
+    """
+    lat, lon, alt = np.meshgrid(
+        np.arange(-90, 90 + step, step),
+        np.arange(-180, 180, step),
+        np.array([-400.0, 0.0, 100.0, 10000.0, 20200000.0]),
+        indexing="ij",
+    )
+    lat = lat.ravel()
+    lon = lon.ravel()
+    alt = alt.ravel()
+
+    ref_ecef = lla2ecef_array(lat, lon, alt)
+    ecef_err = np.linalg.norm(geodetic2ecef(lat, lon, alt) - ref_ecef, axis=1).max()
+
+    # Compare the inverse in meters, by converting the result back through pyproj
+    lla = ecef2geodetic(ref_ecef)
+    back = lla2ecef_array(lla[:, 0], lla[:, 1], lla[:, 2])
+    lla_err = np.linalg.norm(back - ref_ecef, axis=1).max()
+
+    print(f"WGS84 check over {lat.size} points (tolerance {tol * 1000:.3f} mm)")
+    print(f" - geodetic2ecef max error: {ecef_err * 1000:.6f} mm")
+    print(f" - ecef2geodetic max error: {lla_err * 1000:.6f} mm")
+
+    return ecef_err <= tol and lla_err <= tol
+
+
+def bench_lla2ecef(rows: int = 20000):
+    """
+    Print the rows/s of the scalar path (a new Transformer per row, as done
+    before the cache existed), the cached scalar path and lla2ecef_array.
+    """
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-90, 90, rows)
+    lon = rng.uniform(-180, 180, rows)
+    alt = rng.uniform(-100, 10000, rows)
+
+    # The uncached path is slow, only time a part of the rows
+    n_slow = min(rows, 500)
+    now = time.perf_counter()
+    for i in range(n_slow):
+        Transformer.from_crs("epsg:4979", "epsg:4978").transform(lat[i], lon[i], alt[i])
+    t_new = time.perf_counter() - now
+
+    now = time.perf_counter()
+    for i in range(rows):
+        lla2ecef(lat[i], lon[i], alt[i])
+    t_cached = time.perf_counter() - now
+
+    now = time.perf_counter()
+    lla2ecef_array(lat, lon, alt)
+    t_array = time.perf_counter() - now
+
+    now = time.perf_counter()
+    geodetic2ecef(lat, lon, alt)
+    t_numpy = time.perf_counter() - now
+
+    print(f"new Transformer per row : {n_slow / t_new:12.0f} rows/s")
+    print(f"cached scalar lla2ecef  : {rows / t_cached:12.0f} rows/s")
+    print(f"lla2ecef_array          : {rows / t_array:12.0f} rows/s")
+    print(f"geodetic2ecef (numpy)   : {rows / t_numpy:12.0f} rows/s")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if "check" in sys.argv[1:]:
+        sys.exit(0 if check_wgs84() else 1)
+
+    bench_lla2ecef()
@@ -0,0 +1,456 @@
+###############################################################################
+# Gdoper                                                                      #
+#                                                                             #
+# File:  ephemeris.py
+#
+# Description:
+# Broadcast ephemeris of all GPS satellites stacked in arrays, and the
+# Keplerian propagation of their positions for many epochs at once.
+#                                                                             #
+###############################################################################
+
+from xarray.core.dataset import Dataset
+from typing import List
+import numpy as np
+import time
+import copy
+import os
+
+from common import *
+
+# Required tolerance for the eccentricity anomaly error
+ECC_TOL = 0.001
+KEPLER_MAX_ITER = 10
+
+GM = 3.986004418e14  # Earth's gravitational constant (m^3/s^2)
+OMEGA_E = 7.2921151467e-5  # Earth's rotation rate (rad/s)
+
+GPS_EPOCH = np.datetime64("1980-01-06T00:00:00", "us")
+WEEK_SECONDS = 604800
+
+# Fit interval of the messages that don't give one (hours)
+DEFAULT_FIT_HOURS = 4
+
+# Piecewise Chebyshev fits of the orbits: arc length (s), degree and error bound (m)
+CHEB_ARC = 1800
+CHEB_DEGREE = 8
+CHEB_TOL = 0.001
+CHEB_MAX_SPLITS = 4
+
+# Rows of the daily position cube: every second of the day, plus the next midnight
+CUBE_ROWS = 86400 + 1
+
+# Broadcast parameters used for the propagation, as named by georinex
+EPH_PARAMS = (
+    "sqrtA",
+    "DeltaN",
+    "Eccentricity",
+    "M0",
+    "omega",
+    "Cuc",
+    "Cus",
+    "Cic",
+    "Cis",
+    "Crc",
+    "Crs",
+    "Io",
+    "IDOT",
+    "Omega0",
+    "OmegaDot",
+    "Toe",
+    "GPSWeek",
+)
+
+
+class Ephemeris:
+    def __init__(self, nav: Dataset):
+        """
+        Stack the NAV messages of a georinex NAV Dataset (dims time, sv) in
+        (S, M) arrays: one row per satellite, one column per NAV message.\n
+        Satellites without any complete message are left out.
+        """
+        stacked = np.stack([nav[p].transpose("sv", "time").values for p in EPH_PARAMS])
+        valid = ~np.isnan(stacked).any(axis=0)  # (S, M)
+
+        has_data = valid.any(axis=1)
+        self.prns: List[str] = [str(p) for p in nav["sv"].values[has_data]]
+        self.valid = valid[has_data]
+
+        # Unused columns are NaN, so they can never be selected
+        stacked = stacked[:, has_data]
+        stacked[:, ~self.valid] = np.nan
+        self.params = dict(zip(EPH_PARAMS, stacked))
+
+        # Half of the fit interval (hours, 0 if unknown) of every message, in seconds
+        fit = np.full(self.valid.shape, np.nan)
+        if "FitIntvl" in nav:
+            fit = nav["FitIntvl"].transpose("sv", "time").values[has_data]
+        self.half_fit = np.where(fit > 0, fit, DEFAULT_FIT_HOURS) * 3600 / 2
+
+        self.__index()
+
+    def __index(self):
+        """
+        Compute the times of ephemeris of the messages in self.params, and
+        their order for every satellite
+        """
+        # Times are handled as seconds since the start of the first GPS week,
+        # small enough to keep sub-microsecond precision in float64
+        first_week = np.nanmin(self.params["GPSWeek"]) if self.valid.any() else 0
+        self.t_ref = GPS_EPOCH + np.timedelta64(int(first_week) * WEEK_SECONDS, "s")
+
+        # Time of ephemeris of every message
+        self.toe = (self.params["GPSWeek"] - first_week) * WEEK_SECONDS + self.params["Toe"]
+
+        # Per satellite, the messages sorted by time of ephemeris (unused ones last)
+        self.toe_order = np.argsort(self.toe, axis=1, kind="stable")
+        self.toe_sorted = np.take_along_axis(self.toe, self.toe_order, axis=1)
+        self.toe_count = self.valid.sum(axis=1)
+
+    @staticmethod
+    def merge(ephs: List["Ephemeris"]) -> "Ephemeris":
+        """
+        Return the ephemeris with the NAV messages of all of 'ephs' (e.g. of
+        consecutive days), for all of their satellites
+        """
+        prns = sorted(set().union(*[e.prns for e in ephs]))
+        widths = [e.valid.shape[1] for e in ephs]
+
+        eph = copy.copy(ephs[0])
+        eph.prns = prns
+        eph.valid = np.zeros((len(prns), sum(widths)), dtype=bool)
+        eph.half_fit = np.full(eph.valid.shape, np.nan)
+        eph.params = {k: np.full(eph.valid.shape, np.nan) for k in EPH_PARAMS}
+
+        start = 0
+        for e, width in zip(ephs, widths):
+            rows = np.array([prns.index(prn) for prn in e.prns], dtype=np.intp)[:, None]
+            cols = np.arange(start, start + width)[None, :]
+            eph.valid[rows, cols] = e.valid
+            eph.half_fit[rows, cols] = e.half_fit
+            for k in EPH_PARAMS:
+                eph.params[k][rows, cols] = e.params[k]
+            start += width
+
+        eph.__index()
+        return eph
+
+    def subset(self, prns: List[str]) -> "Ephemeris":
+        """
+        Return the ephemeris of some of the satellites, with copies of their rows
+        """
+        rows = [self.prns.index(prn) for prn in prns]
+
+        eph = copy.copy(self)
+        eph.prns = list(prns)
+        eph.params = {k: v[rows] for k, v in self.params.items()}
+        for name in ("valid", "toe", "half_fit", "toe_order", "toe_sorted", "toe_count"):
+            setattr(eph, name, getattr(self, name)[rows])
+
+        return eph
+
+    def select(self, times: np.ndarray) -> np.ndarray:
+        """
+        Return the (T, S) indices of the NAV message used for each time and
+        satellite: the one with the nearest time of ephemeris.\n
+        Times outside the fit interval of every message still get the
+        nearest one, see in_fit().
+        """
+        t = self.seconds(times)
+        idx = np.empty((len(t), len(self.prns)), dtype=np.intp)
+
+        for s, count in enumerate(self.toe_count):
+            toe = self.toe_sorted[s, :count]
+
+            if count == 1:
+                idx[:, s] = self.toe_order[s, 0]
+                continue
+
+            i = np.clip(np.searchsorted(toe, t), 1, count - 1)
+            i = np.where(t - toe[i - 1] <= toe[i] - t, i - 1, i)
+            idx[:, s] = self.toe_order[s, i]
+
+        return idx
+
+    def in_fit(self, times: np.ndarray, idx: np.ndarray) -> np.ndarray:
+        """
+        Return the (T, S) mask of the selected NAV messages ('idx', see
+        select()) that are within their fit interval at 'times'.
+        """
+        sats = np.arange(len(self.prns))[None, :]
+        dt = self.seconds(times)[:, None] - self.toe[sats, idx]
+        return np.abs(dt) <= self.half_fit[sats, idx]
+
+    def positions(self, times: np.ndarray, idx: np.ndarray = None) -> np.ndarray:
+        """
+        Return the (T, S, 3) ECEF positions of all satellites at 'times'.\n
+        'idx' are the (T, S) NAV messages to use, see select().
+        """
+        if idx is None:
+            idx = self.select(times)
+
+        return self.kepler(self.seconds(times), idx)
+
+    def seconds(self, times: np.ndarray) -> np.ndarray:
+        """
+        Return 'times' (datetimes or ISO strings) as seconds since t_ref
+        """
+        times = np.asarray(times, dtype="datetime64[us]")
+        return (times - self.t_ref) / np.timedelta64(1, "s")
+
+    def kepler(self, t: np.ndarray, idx: np.ndarray) -> np.ndarray:
+        """
+        Return the (T, S, 3) ECEF positions at 't' (T,) seconds since
+        t_ref, from the NAV messages 'idx' (T, S).
+        """
+        sats = np.arange(len(self.prns))[None, :]
+        p = {k: v[sats, idx] for k, v in self.params.items()}
+
+        # Seconds since the time of ephemeris
+        tk = t[:, None] - self.toe[sats, idx]
+
+        return kepler2ecef(p, tk)
+
+
+class ChebyshevOrbits:
+    def __init__(
+        self,
+        eph: Ephemeris,
+        start,
+        end,
+        arc: float = CHEB_ARC,
+        degree: int = CHEB_DEGREE,
+        tol: float = CHEB_TOL,
+    ):
+        """
+        Fit the Keplerian orbits of 'eph' between 'start' and 'end' with
+        Chebyshev polynomials of 'degree', one per satellite and arc of
+        'arc' seconds. Arcs start at 'start'.\n
+        Each arc uses the NAV message selected at its middle, so the usual
+        NAV message changes (at odd hours) fall on arc boundaries when
+        'start' is a whole hour.\n
+        The fits are checked against the Keplerian positions between the
+        fitting nodes, arcs are halved until the error is below 'tol' meters.
+        """
+        self.eph = eph
+        self.prns = eph.prns
+        self.t0 = np.datetime64(start, "us")
+        self.start = eph.seconds([start])[0]
+        self.end = eph.seconds([end])[0]
+        self.degree = degree
+
+        for _ in range(CHEB_MAX_SPLITS + 1):
+            self.arc = arc
+            self.coefs, self.error = self.__fit()
+            if self.error <= tol:
+                return
+            arc = arc / 2
+
+        raise Exception(f"Chebyshev fit error ({self.error:.3g} m) is over {tol} m.")
+
+    def __fit(self):
+        """
+        Return the (arcs, degree + 1, S, 3) Chebyshev coefficients of all
+        arcs, and the largest error found at the check points.
+        """
+        n_arcs = max(int(np.ceil((self.end - self.start) / self.arc)), 1)
+        starts = self.start + self.arc * np.arange(n_arcs)
+
+        # Chebyshev nodes of the first kind, in [-1, 1]
+        n = self.degree + 1
+        nodes = np.cos(np.pi * (np.arange(n) + 0.5) / n)
+        t_nodes = starts[:, None] + (nodes + 1) / 2 * self.arc  # (arcs, n)
+
+        xyz = self.__kepler(starts, t_nodes)  # (arcs, n, S, 3)
+
+        # Interpolating coefficients: c_j = 2/n sum_k f(x_k) T_j(x_k), c_0 halved
+        cheb = np.cos(np.outer(np.arange(n), np.arccos(nodes)))  # (n, n)
+        coefs = 2 / n * np.einsum("jk,aksc->ajsc", cheb, xyz)
+        coefs[:, 0] /= 2
+
+        # Check between the nodes (and at the ends) of every arc
+        x_check = np.linspace(-1, 1, 4 * n + 1)
+        t_check = starts[:, None] + (x_check + 1) / 2 * self.arc
+        ref = self.__kepler(starts, t_check)
+        fitted = np.stack([clenshaw(x_check, c) for c in coefs])
+        error = np.nanmax(np.linalg.norm(fitted - ref, axis=-1), initial=0)
+
+        return coefs, error
+
+    def __kepler(self, starts: np.ndarray, t: np.ndarray) -> np.ndarray:
+        """
+        Return the Keplerian positions (arcs, points, S, 3) at 't' (arcs,
+        points) seconds since t_ref, with the NAV message selected for each arc.
+        """
+        mid = self.eph.t_ref + ((starts + self.arc / 2) * 1e6).astype("timedelta64[us]")
+        idx = np.repeat(self.eph.select(mid), t.shape[1], axis=0)
+
+        return self.eph.kepler(t.ravel(), idx).reshape(t.shape + (len(self.prns), 3))
+
+    def positions(self, times: np.ndarray) -> np.ndarray:
+        """
+        Return the (T, S, 3) ECEF positions of all satellites at 'times'.
+        Times out of the fitted span are computed with the Keplerian orbits.
+        """
+        times = np.asarray(times, dtype="datetime64[us]")
+
+        # Seconds since the start, exact to the microsecond
+        t = (times - self.t0) / np.timedelta64(1, "s")
+        inside = (t >= 0) & (t <= self.end - self.start)
+
+        xyz = np.empty((len(t), len(self.prns), 3))
+        if not inside.all():
+            xyz[~inside] = self.eph.positions(times[~inside])
+
+        # Arc of every time, each arc is evaluated at all its times at once
+        rows = np.flatnonzero(inside)
+        a = np.minimum((t[rows] // self.arc).astype(np.intp), len(self.coefs) - 1)
+        for k in np.unique(a):
+            in_arc = rows[a == k]
+            x = 2 * (t[in_arc] - k * self.arc) / self.arc - 1
+            xyz[in_arc] = clenshaw(x, self.coefs[k])
+
+        return xyz
+
+
+class PositionCube:
+    def __init__(self, filename: str, eph: Ephemeris, day):
+        """
+        Memory map a position cube written by PositionCube.write(): the
+        float32 ECEF positions of all satellites of 'eph' at every second of
+        'day', (CUBE_ROWS, S, 3). Processes mapping the same file share its pages.
+        """
+        self.eph = eph
+        self.prns = eph.prns
+        self.t0 = np.datetime64(day, "D").astype("datetime64[us]")
+        self.xyz = np.load(filename, mmap_mode="r")
+
+        if self.xyz.shape != (CUBE_ROWS, len(self.prns), 3):
+            raise Exception(f'"{filename}" is not a position cube of {len(self.prns)} satellites.')
+
+    @staticmethod
+    def write(filename: str, eph: Ephemeris, day, block: int = 3600):
+        """
+        Compute the positions of all satellites of 'eph' at every second of
+        'day', 'block' seconds at a time, into the cube file 'filename'
+        """
+        t0 = np.datetime64(day, "D").astype("datetime64[us]")
+
+        # Written under a name of this process, other processes may be writing it too
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        xyz = np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=np.float32, shape=(CUBE_ROWS, len(eph.prns), 3)
+        )
+        for start in range(0, CUBE_ROWS, block):
+            seconds = np.arange(start, min(start + block, CUBE_ROWS))
+            xyz[seconds] = eph.positions(t0 + seconds.astype("timedelta64[s]"))
+
+        xyz.flush()
+        del xyz
+        os.replace(tmp, filename)
+
+    def positions(self, times: np.ndarray) -> np.ndarray:
+        """
+        Return the (T, S, 3) ECEF positions of all satellites at 'times',
+        linearly interpolated between seconds.\n
+        Float32 storage rounds positions to ~2 m, the interpolation adds
+        < 0.1 m. Times out of the day are computed with the Keplerian orbits.
+        """
+        times = np.asarray(times, dtype="datetime64[us]")
+
+        t = (times - self.t0) / np.timedelta64(1, "s")
+        inside = (t >= 0) & (t <= CUBE_ROWS - 1)
+
+        xyz = np.empty((len(t), len(self.prns), 3))
+        if not inside.all():
+            xyz[~inside] = self.eph.positions(times[~inside])
+
+        t = t[inside]
+        i = np.minimum(t.astype(np.intp), CUBE_ROWS - 2)
+        f = (t - i)[:, None, None]
+        xyz[inside] = (1 - f) * self.xyz[i] + f * self.xyz[i + 1]
+
+        return xyz
+
+
+def clenshaw(x: np.ndarray, coefs: np.ndarray) -> np.ndarray:
+    """
+    Evaluate the Chebyshev series 'coefs' (degree + 1, S, 3) at the points
+    'x' (P,) in [-1, 1] with the Clenshaw recurrence. Returns (P, S, 3).
+    """
+    x = x[:, None, None]
+
+    b1 = b2 = 0
+    for c in coefs[:0:-1]:
+        b1, b2 = 2 * x * b1 - b2 + c, b1
+
+    return x * b1 - b2 + coefs[0]
+
+
+def kepler2ecef(p: dict, tk: np.ndarray) -> np.ndarray:
+    """
+    Return the ECEF positions (..., 3) for the broadcast parameters 'p'
+    (arrays of the same shape as tk), 'tk' seconds after their time of
+    ephemeris. Parameters and equations are those of IS-GPS-200.
+    """
+    e = p["Eccentricity"]
+    A = p["sqrtA"] ** 2
+    n = np.sqrt(GM / A**3) + p["DeltaN"]
+
+    # Kepler's equation M = E - e sin(E), solved with Newton's method
+    Mk = p["M0"] + n * tk
+    Ek = Mk.copy()
+    for _ in range(KEPLER_MAX_ITER):
+        dE = (Ek - e * np.sin(Ek) - Mk) / (1 - e * np.cos(Ek))
+        Ek -= dE
+        if not np.nanmax(np.abs(dE), initial=0) >= ECC_TOL:
+            break
+
+    nuk = np.arctan2(np.sqrt(1 - e**2) * np.sin(Ek), np.cos(Ek) - e)
+    phik = nuk + p["omega"]
+    cos2, sin2 = np.cos(2 * phik), np.sin(2 * phik)
+
+    uk = phik + p["Cuc"] * cos2 + p["Cus"] * sin2
+    rk = A * (1 - e * np.cos(Ek)) + p["Crc"] * cos2 + p["Crs"] * sin2
+    ik = p["Io"] + p["IDOT"] * tk + p["Cic"] * cos2 + p["Cis"] * sin2
+    omegak = p["Omega0"] + (p["OmegaDot"] - OMEGA_E) * tk - OMEGA_E * p["Toe"]
+
+    xk, yk = rk * np.cos(uk), rk * np.sin(uk)
+    cos_o, sin_o, cos_i = np.cos(omegak), np.sin(omegak), np.cos(ik)
+
+    return np.stack(
+        (
+            xk * cos_o - yk * sin_o * cos_i,
+            xk * sin_o + yk * cos_o * cos_i,
+            yk * np.sin(ik),
+        ),
+        axis=-1,
+    )
+
+
+def bench_propagation(nav: Dataset, hours: float = 1, rate: float = 1):
+    """
+    Print the time taken to compute the positions of all satellites for a
+    flight of 'hours' hours, with 'rate' positions per second.
+    """
+    start = nav["time"].values[0].astype("datetime64[us]")
+    times = start + (np.arange(int(hours * 3600 * rate)) * 1e6 / rate).astype("timedelta64[us]")
+
+    now = time.perf_counter()
+    eph = Ephemeris(nav)
+    t_stack = time.perf_counter() - now
+
+    now = time.perf_counter()
+    xyz = eph.positions(times)
+    t_prop = time.perf_counter() - now
+
+    print(f"stacking {len(eph.prns)} satellites : {t_stack * 1000:9.2f} ms")
+    print(f"{xyz.shape[0]} x {xyz.shape[1]} positions  : {t_prop * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    import sys
+    from reader_rinex import load_nav
+
+    # Usage: python ephemeris.py <rinex NAV file> [hours] [rate]
+    bench_propagation(load_nav(sys.argv[1]), *[float(a) for a in sys.argv[2:4]])
@@ -0,0 +1,322 @@
+###############################################################################
+# Gdoper                                                                      #
+#                                                                             #
+# File:  ephemeris_sources.py
+#
+# Description:
+# Places the RINEX NAV files are downloaded from: the Earthscope archive, a
+# local copy of its directory tree, or any HTTP server of such a copy, e.g.
+# the local stand-in server below for working without network.
+#                                                                             #
+###############################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable
+from pathlib import Path
+import threading
+import datetime as dt
+import tempfile
+import random
+import shutil
+import time
+import re
+import os
+
+from common import *
+from d_print import Print
+from rinex_catalog import rinex_file_name
+from unavco.earthscope import get_earthscope_rinex, prefetch_earthscope_rinex, is_compressed
+from unavco.earthscope import archive_path, part_path, lock_download, ARCHIVE_URL, PREFETCH_WORKERS
+
+
+class EphemerisSource:
+    """
+    Where missing RINEX files are downloaded from
+    """
+
+    def fetch(self, station_rinex_file: str, save_dir: str = RINEX_FOLDER) -> bool:
+        """
+        Store a file in 'save_dir'. Returns True if it was stored, False if
+        the source doesn't have it and None if it couldn't be read (e.g. no
+        network), so only False is a known miss.
+        """
+        raise Exception("SubClass.fetch() not defined")
+
+    def name(self) -> str:
+        """
+        Return the name the misses of the source are recorded under
+        """
+        raise Exception("SubClass.name() not defined")
+
+    def fetch_many(
+        self,
+        station_rinex_files: Iterable[str],
+        save_dir: str = RINEX_FOLDER,
+        max_workers: int = PREFETCH_WORKERS,
+    ) -> Dict[str, bool]:
+        """
+        Store many files at the same time, returns the result of fetch() for each one
+        """
+        files = list(dict.fromkeys(station_rinex_files))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return dict(zip(files, pool.map(lambda file: self.fetch(file, save_dir), files)))
+
+
+class HttpSource(EphemerisSource):
+    def __init__(self, base_url: str, auth: bool = False):
+        """
+        Server with the files at 'base_url'/year/day/file. The Earthscope
+        access token is sent if 'auth'.
+        """
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.auth = auth
+
+    def name(self) -> str:
+        return self.base_url
+
+    def fetch(self, station_rinex_file: str, save_dir: str = RINEX_FOLDER) -> bool:
+        return get_earthscope_rinex(station_rinex_file, save_dir, self.base_url, self.auth)
+
+    def fetch_many(
+        self,
+        station_rinex_files: Iterable[str],
+        save_dir: str = RINEX_FOLDER,
+        max_workers: int = PREFETCH_WORKERS,
+    ) -> Dict[str, bool]:
+        return prefetch_earthscope_rinex(
+            station_rinex_files, save_dir, max_workers, self.base_url, self.auth
+        )
+
+
+class EarthscopeSource(HttpSource):
+    def __init__(self):
+        """
+        The Earthscope (UNAVCO) archive, needs an access token
+        """
+        super().__init__(ARCHIVE_URL, auth=True)
+
+
+class MirrorSource(EphemerisSource):
+    def __init__(self, root: str):
+        """
+        Local directory laid out like the archive, root/year/day/file
+        """
+        self.root = Path(root)
+
+    def name(self) -> str:
+        return str(self.root.resolve())
+
+    def fetch(self, station_rinex_file: str, save_dir: str = RINEX_FOLDER) -> bool:
+        source = self.root / archive_path(station_rinex_file)
+        if not source.is_file():
+            return False
+
+        # Same as downloads: complete files only appear under their final name
+        final = Path(save_dir) / station_rinex_file
+        part = part_path(final)
+        lock = lock_download(final)
+        if lock is None:
+            return True
+        try:
+            shutil.copyfile(source, part)
+            if not is_compressed(part):
+                Print("info", f"{source} is corrupt")
+                part.unlink()
+                return None
+
+            os.replace(part, final)
+            return True
+        except OSError as e:
+            # e.g. no permission or no space left
+            Print("info", f"{source} not copied: {e}")
+            with suppress(OSError):
+                part.unlink(missing_ok=True)
+            return None
+        finally:
+            lock.unlink(missing_ok=True)
+
+
+class MirrorServer:
+    def __init__(self, root: str, port: int = 0, delay: float = 0.0, fail_rate: float = 0.0):
+        """
+        Local HTTP server of a directory laid out like the archive, to use
+        instead of it without network. Every request waits 'delay' seconds,
+        and a 'fail_rate' fraction of them fail with 503, to measure the
+        concurrency and the retries of the downloads. Port 0 picks a free port.
+        """
+        self.root = Path(root)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.requests = 0  # Requests served so far
+        self.resumed = 0  # Of them, replied with the end of a file (206)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.__handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread: threading.Thread = None
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.delay)
+                if random.random() < server.fail_rate:
+                    return self.__reply(503)
+
+                fn = server.root / self.path.lstrip("/")
+                if ".." in self.path or not fn.is_file():
+                    return self.__reply(404)
+
+                data = fn.read_bytes()
+                start = re.match(r"bytes=(\d+)-", self.headers.get("range") or "")
+                start = int(start.group(1)) if start else 0
+                if start >= len(data) > 0:
+                    return self.__reply(416)
+
+                self.send_response(206 if start > 0 else 200)
+                if start > 0:
+                    server.resumed += 1
+                    self.send_header("content-range", f"bytes {start}-{len(data)-1}/{len(data)}")
+                self.send_header("content-length", str(len(data) - start))
+                self.end_headers()
+                self.wfile.write(data[start:])
+
+            def __reply(self, code: int):
+                self.send_response(code)
+                self.send_header("content-length", "0")
+                self.end_headers()
+
+        return Handler
+
+    def start(self) -> "MirrorServer":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def source(self) -> HttpSource:
+        return HttpSource(self.url)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def make_mirror(root: str, rinex_file: str, station: str, days: Iterable[dt.date]):
+    """
+    Fill a mirror directory with copies of 'rinex_file' as the files of a
+    station on 'days' (for benchmarks)
+    """
+    for day in days:
+        path = Path(root) / archive_path(rinex_file_name(station, day))
+        os.makedirs(path.parent, exist_ok=True)
+        shutil.copyfile(rinex_file, path)
+
+
+def test_downloads():
+    """
+    Check against the local stand-in server that downloads resume partial
+    files (also those left by killed processes), wait for other downloads of
+    the same file, start again when the partial file is longer than the
+    remote one (416), and don't keep corrupt, missing or old partial files
+    """
+    import unavco.earthscope as earthscope
+    from unavco.earthscope import LZW_MAGIC
+
+    earthscope.DL_BACKOFF = 0.01
+    data = LZW_MAGIC + os.urandom(200_000)
+    day = dt.date(2021, 4, 5)
+    good, corrupt, missing = (rinex_file_name(station, day) for station in ("good", "bad_", "none"))
+
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as save_dir:
+        for name, contents in ((good, data), (corrupt, b"<html>" + data[6:])):
+            path = Path(root) / archive_path(name)
+            os.makedirs(path.parent, exist_ok=True)
+            path.write_bytes(contents)
+
+        final = Path(save_dir) / good
+        lock = final.with_name(final.name + ".lock")
+        old = part_path(Path(save_dir) / rinex_file_name("old_", day))
+        old.write_bytes(data[:1000])
+        os.utime(old, (0, 0))
+
+        with MirrorServer(root) as server:
+            source = server.source()
+
+            # Resumed after the bytes already downloaded by a killed process
+            part_path(final).write_bytes(data[:1000])
+            lock.touch()
+            os.utime(lock, (0, 0))
+            assert source.fetch(good, save_dir) is True and server.resumed == 1
+            assert final.read_bytes() == data, "Resumed download differs"
+            assert not old.exists(), "Old partial file kept"
+
+            # Partial file longer than the remote one: 416, downloaded again,
+            # after the download of another process (its lock) ends
+            final.unlink()
+            part_path(final).write_bytes(data + b"extra")
+            lock.touch()
+            threading.Timer(2 * earthscope.LOCK_POLL, lock.unlink).start()
+            assert source.fetch(good, save_dir) is True and final.read_bytes() == data
+
+            # Not a compressed file: retried, then given up without keeping it
+            assert source.fetch(corrupt, save_dir) is None
+            assert source.fetch(missing, save_dir) is False
+            assert sorted(os.listdir(save_dir)) == [good], "Corrupt or partial files kept"
+
+    Print("info", "Downloads resume, wait for each other, restart and discard corrupt files")
+
+
+def bench_sources(n_files: int = 32, delay: float = 0.2, fail_rate: float = 0.1):
+    """
+    Time the download of 'n_files' files from the local stand-in server with
+    different numbers of threads, and from a local mirror directory
+    """
+    import unavco.earthscope as earthscope
+
+    rinex_file = next(Path(RINEX_FOLDER).glob("*.Z"))
+    days = [dt.date(2019, 1, 1) + dt.timedelta(days=i) for i in range(100, 100 + n_files)]
+    files = [rinex_file_name("bnch", day) for day in days]
+    earthscope.DL_BACKOFF = 0.05
+
+    with tempfile.TemporaryDirectory() as root:
+        make_mirror(root, rinex_file, "bnch", days)
+
+        with MirrorServer(root, delay=delay, fail_rate=fail_rate) as server:
+            for workers in (1, 4, 8, 16):
+                with tempfile.TemporaryDirectory() as save_dir:
+                    server.requests = 0
+                    now = time.perf_counter()
+                    done = server.source().fetch_many(files, save_dir, workers)
+                    elapsed = time.perf_counter() - now
+                    stored = sum(result is True for result in done.values())
+                    Print(
+                        "info",
+                        f"HTTP, {workers:2} threads: {elapsed:6.2f}s, {n_files / elapsed:6.1f} files/s,"
+                        + f" {stored}/{n_files} files in {server.requests} requests",
+                    )
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            now = time.perf_counter()
+            done = MirrorSource(root).fetch_many(files, save_dir)
+            elapsed = time.perf_counter() - now
+            stored = sum(result is True for result in done.values())
+            Print("info", f"Mirror directory: {elapsed:6.2f}s, {stored}/{n_files} files")
+
+
+if __name__ == "__main__":
+    test_downloads()
+    bench_sources()
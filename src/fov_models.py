@@ -1,6 +1,7 @@
 from typing import List, Mapping, Tuple
 import numpy as np
 from common import *
+from geometry import SatGeometry
 
 
 class FOV_model:
@@ -47,45 +48,36 @@ class FOV_view_match(FOV_model):
         """
         return [CHN_LAT, CHN_LON, CHN_ALT, CHN_UTC, CHN_SAT]
 
-    def get_sats(self, pos_pos, sats_pos) -> Mapping[str, Mapping[str, Tuple[float, float, float]]]:
+    def get_sats(self, pos_pos, sats_pos) -> SatGeometry:
         """
         Calculate the satellites in view, given the measured amount of
-        visible satellites, at every time and place.
+        visible satellites, at every time and place.\n
+        'sats_pos' is the SatGeometry of the rows of 'pos_pos', the result is
+        the same geometry with the satellites in view marked as visible.
+        Dicts of {time: {prn: (x,y,z)}} are also accepted, and returned.
         """
-        # Sats pos is ordered like:  times{} -> prn{} = (x,y,z)
-
-        # initialize output map
-        sats_LOS = {}
-        for t in pos_pos[CHN_UTC]:
-            sats_LOS[t] = {}
-
-        # Calculate best visible sats
-        for i in range(len(pos_pos[CHN_UTC])):
-            t = pos_pos[CHN_UTC][i]  # Timestamps from pos_data
-            n_s = int(pos_pos[CHN_SAT][i])  # n. of visible sats at 't'
-
-            lat = pos_pos[CHN_LAT][i]
-            lon = pos_pos[CHN_LON][i]
-            alt = pos_pos[CHN_ALT][i]
-
-            u = np.array(lla2ecef(lat, lon, alt))
-            u = u / np.linalg.norm(u)
-
-            dots = {}
-            # Calculate dot prod to all sats
-            for sat in sats_pos[t]:
-                p_s = np.array(sats_pos[t][sat])
-                p_s = p_s / np.linalg.norm(p_s)
-                dots[np.dot(u, p_s)] = sat
-
-            # Order in terms of largest abs value
-            ordered = sorted(dots.keys(), key=np.abs, reverse=True)
-
-            # Set the n_s most visible satellites as the ones in FOV
-            for j in range(n_s):
-                dot = ordered[j]
-                sat = dots[dot]
-                sats_LOS[t][sat] = sats_pos[t][sat]
-
-        # sats_LOS is ordered like:  times{} -> prn{} = (x,y,z)
-        return sats_LOS
+        if not isinstance(sats_pos, SatGeometry):
+            los = self.get_sats(pos_pos, SatGeometry.from_dict(sats_pos, pos_pos[CHN_UTC]))
+            return los.to_dict(pos_pos[CHN_UTC])
+
+        # Receiver positions for all rows at once
+        rx_lla = np.column_stack(
+            (
+                np.asarray(pos_pos[CHN_LAT], dtype=np.float64),
+                np.asarray(pos_pos[CHN_LON], dtype=np.float64),
+                np.asarray(pos_pos[CHN_ALT], dtype=np.float64),
+            )
+        )
+        rx_ecef = lla2ecef_array(rx_lla[:, 0], rx_lla[:, 1], rx_lla[:, 2])
+
+        # Rank satellites by elevation, highest first (satellites without a position last)
+        _, el, _ = ecef2aer(rx_ecef, sats_pos.xyz, rx_lla)
+        el[~sats_pos.visible] = np.nan
+        ranked = np.argsort(-el, axis=1)
+
+        # Set the n_s most visible satellites as the ones in FOV
+        n_s = np.asarray(pos_pos[CHN_SAT]).astype(np.intp)[:, None]
+        in_fov = np.zeros_like(sats_pos.visible)
+        np.put_along_axis(in_fov, ranked, np.arange(ranked.shape[1]) < n_s, axis=1)
+
+        return sats_pos.with_visible(in_fov & sats_pos.visible)
@@ -0,0 +1,86 @@
+###############################################################################
+# Gdoper                                                                      #
+#                                                                             #
+# File:  geometry.py
+#
+# Description:
+# Container for the positions of the satellites at many epochs, passed from
+# the orbital data to the FOV models and the calculations.
+#                                                                             #
+###############################################################################
+
+from typing import Dict, List, Mapping, Tuple
+import numpy as np
+
+
+class SatGeometry:
+    def __init__(self, epochs, prns: List[str], xyz: np.ndarray, visible: np.ndarray = None):
+        """
+        Positions of satellites 'prns' at 'epochs' (T,), as a (T, S, 3) ECEF
+        array 'xyz', and the (T, S) mask of the satellites that are visible
+        (all of them if not given).
+        """
+        self.epochs = np.asarray(epochs, dtype="datetime64[us]")
+        self.prns = list(prns)
+        self.xyz = np.asarray(xyz, dtype=np.float64)
+        self.visible = np.ones(self.xyz.shape[:2], dtype=bool) if visible is None else visible
+
+        if self.xyz.shape != (len(self.epochs), len(self.prns), 3):
+            raise Exception(
+                f"Positions of shape {self.xyz.shape} don't match"
+                + f" {len(self.epochs)} epochs and {len(self.prns)} satellites."
+            )
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def __getitem__(self, rows) -> "SatGeometry":
+        """
+        Return the geometry of some epochs. Slices are views of this one.
+        """
+        return SatGeometry(self.epochs[rows], self.prns, self.xyz[rows], self.visible[rows])
+
+    def prn_index(self) -> Dict[str, int]:
+        return {prn: i for i, prn in enumerate(self.prns)}
+
+    def with_visible(self, visible: np.ndarray) -> "SatGeometry":
+        """
+        Return the same positions (not copied) with another visibility mask
+        """
+        return SatGeometry(self.epochs, self.prns, self.xyz, visible)
+
+    def to_dict(self, keys: list = None) -> Mapping[str, Mapping[str, Tuple[float, float, float]]]:
+        """
+        Return the visible satellites as {time: {prn: (x,y,z)}}, the format
+        used before this container. 'keys' are the times used as keys, one
+        per epoch (ISO formatted epochs if not given).
+        """
+        if keys is None:
+            keys = [t.isoformat(sep=" ") for t in self.epochs.tolist()]
+
+        sats = {t: {} for t in keys}
+        for i, t in enumerate(keys):
+            for s in np.flatnonzero(self.visible[i]):
+                sats[t][self.prns[s]] = self.xyz[i, s]
+
+        return sats
+
+    @staticmethod
+    def from_dict(sats: Mapping[str, Mapping[str, Tuple[float, float, float]]], keys: list = None):
+        """
+        Return the geometry of {time: {prn: (x,y,z)}} at the times 'keys'
+        (all the times in 'sats' if not given). Satellites missing at a time
+        are not visible.
+        """
+        keys = list(sats.keys()) if keys is None else list(keys)
+        prns = list(dict.fromkeys(prn for t in dict.fromkeys(keys) for prn in sats[t]))
+
+        index = {prn: i for i, prn in enumerate(prns)}
+        xyz = np.full((len(keys), len(prns), 3), np.nan)
+        visible = np.zeros((len(keys), len(prns)), dtype=bool)
+        for i, t in enumerate(keys):
+            for prn, pos in sats[t].items():
+                xyz[i, index[prn]] = pos
+                visible[i, index[prn]] = True
+
+        return SatGeometry(keys, prns, xyz, visible)
@@ -8,15 +8,26 @@
 #
 # Description:
 # Reads csv data from a file that has positional data. Methods can be used to
-# return this data properly formatted for further processing.
+# return this data properly formatted for further processing. Parquet and
+# Arrow files are read through pyarrow, if it is installed.
 #                                                                             #
 ###############################################################################
 
 
 # %%
 import os
+import sys
 import csv
-from typing import List, Tuple
+import json
+import time
+import hashlib
+import importlib.util
+import warnings
+import tempfile
+import shutil
+import numpy as np
+from itertools import islice, product
+from typing import Iterator, List, Tuple
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
@@ -25,23 +36,101 @@ from common import *
 
 os.chdir("..")  # gdoper.py directory
 
+# Default amount of rows per block when streaming a file
+CHUNK_ROWS = 50000
+
+# Counter time (ms) after a row used to rebuild its sub-second time, see fuse_ms()
+FUSE_WINDOW_MS = 2000
+
+# Binary sidecar cache of the typed columns, stored in "<filename><SIDECAR_SUFFIX>/"
+SIDECAR_SUFFIX = ".gdoper"
+SIDECAR_VERSION = 1
+
+# File extensions read with pyarrow, and their pyarrow.dataset format
+COLUMNAR_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "ipc",
+    ".feather": "ipc",
+    ".ipc": "ipc",
+}
+
 
 class PosData:
-    def __init__(self, filename):
+    def __init__(
+        self, filename, typed=False, chunk_rows=0, cache=False, utc_range=None, subsecond=False
+    ):
         self.filename = filename
         self.var_count = 0
         self.row_count = 0
         self.data = {}
+        self.typed = typed  # Columns as typed NumPy arrays instead of lists of strings
+        self.chunk_rows = chunk_rows  # If > 0, data is streamed in blocks and not kept in memory
+        self.columns = None  # Names of the columns to read, None reads all of them
+        self.cache = cache  # Use (and write) the binary sidecar cache in typed mode
+        self.sidecar_dir = str(filename) + SIDECAR_SUFFIX
+        self.utc_range = utc_range  # (start, end) UTC times to keep, inclusive. None is open
+        self.subsecond = subsecond  # Rebuild sub-second UTC times from CHN_MS, if it exists
+        self.format = COLUMNAR_FORMATS.get(os.path.splitext(str(filename))[1].lower(), "csv")
         self.done_setup = False
         self.debuging = "none"
 
     # TODO: Create setup function
-    def setup(self):
+    def setup(self, columns=None):
+        """
+        Check the file and read its data.\n
+        If 'columns' is given, only those columns are parsed and stored.
+        """
         if not os.path.exists(self.filename):
             raise Exception(f'"{self.filename}" does not exist. Input full dir.')
 
+        if columns is not None:
+            self.columns = list(columns)
+
+        # pyarrow is only imported when reading columnar files (slow to import)
+        if self.format != "csv" and importlib.util.find_spec("pyarrow") is None:
+            raise Exception(f'pyarrow is required to read "{self.filename}".')
+
+        if self.utc_range is not None and self.format == "csv":
+            if not self.typed and self.chunk_rows <= 0:
+                raise Exception("A utc_range can only be used on typed or streamed data.")
+            if self.columns is not None and CHN_UTC not in self.columns:
+                raise Exception(f'A utc_range requires the "{CHN_UTC}" column.')
+
         self.done_setup = True
-        self.data = self.get_ordered_data()
+        if self.format != "csv":
+            # Columnar files are always typed, the time range is pushed down to the reader
+            self.typed = True
+            if self.chunk_rows <= 0:
+                self.data = self.get_columnar_data()
+        else:
+            if self.cache and (self.typed or self.chunk_rows > 0):
+                # Memory mapped columns, empty if the sidecar is missing or outdated
+                self.data = self.load_sidecar()
+
+            if len(self.data) > 0:
+                self.typed = True
+            elif self.chunk_rows > 0:
+                # Streamed with iter_chunks(), always typed
+                self.typed = True
+            elif self.typed:
+                self.data = self.get_typed_data()
+                if self.cache:
+                    self.write_sidecar()
+            else:
+                self.data = self.get_ordered_data()
+
+        if self.chunk_rows > 0:
+            # Mapped sidecar columns are fused and sliced block by block in
+            # iter_chunks(), so streaming keeps its memory use constant
+            pass
+        elif self.typed and len(self.data) > 0:
+            self.data = self.__fuse_ms(self.data, {})
+
+        if self.utc_range is not None and len(self.data) > 0 and self.chunk_rows <= 0:
+            rows = self.__utc_slice(self.data[CHN_UTC])
+            self.data = {chn: col[rows] for chn, col in self.data.items()}
+            self.row_count = rows.stop - rows.start
 
         # Debug('Done setup\n')
 
@@ -68,6 +157,385 @@ class PosData:
 
         return ordered
 
+    def get_typed_data(self) -> dict:
+        """
+        Read the csv straight into a structured NumPy array, with one typed
+        field per column (see CHN_TYPES), and return a mapping of the column
+        names to views of their fields.\n
+        Unknown columns are float64 if their first value is a number and
+        Python objects (strings) otherwise.
+        """
+        self.setup_check()
+
+        with open(self.filename, "r") as file:
+            titles, dtype, usecols = self.__typed_header(file)
+            start = file.tell()
+
+            try:
+                table = load_typed(file, dtype, usecols)
+            except ValueError:
+                Print("debug0", f"Falling back to tolerant parsing of {self.filename}")
+                file.seek(start)
+                table = load_typed(file, dtype, usecols, tolerant=True)
+
+        self.var_count = len(titles)
+        self.row_count = len(table)
+
+        # Field views share the memory of 'table'
+        return {t: table[t] for t in titles}
+
+    def iter_chunks(self, rows: int = 0) -> Iterator[dict]:
+        """
+        Yield the data in blocks of about 'rows' rows (self.chunk_rows, or
+        CHUNK_ROWS, if not given). Blocks are dicts of column name -> column.\n
+        If setup() loaded the data the blocks are views of it. Otherwise the
+        file (or the mapped sidecar) is streamed, and only one typed block is
+        in memory at a time.
+        """
+        self.setup_check()
+
+        if rows <= 0:
+            rows = self.chunk_rows if self.chunk_rows > 0 else CHUNK_ROWS
+
+        if len(self.data) > 0 and self.chunk_rows <= 0:
+            for start in range(0, self.row_count, rows):
+                yield {chn: col[start : start + rows] for chn, col in self.data.items()}
+            return
+
+        if len(self.data) > 0:
+            blocks = self.__sidecar_blocks(rows, self.row_count)
+        elif self.format != "csv":
+            blocks = self.__columnar_blocks(rows)
+        else:
+            blocks = self.__csv_blocks(rows)
+
+        self.row_count = 0
+        for block in self.__fused_blocks(blocks):
+            if self.utc_range is not None and (self.format == "csv" or self.subsecond):
+                # Columnar files are filtered by the reader, on whole seconds
+                rows_in = self.__utc_slice(block[CHN_UTC])
+                block = {chn: col[rows_in] for chn, col in block.items()}
+                if rows_in.stop == rows_in.start:
+                    continue
+
+            self.row_count += block_rows(block)
+            yield block
+
+    def __columnar_blocks(self, rows: int) -> Iterator[dict]:
+        dataset, columns = self.__dataset()
+        self.var_count = len(columns)
+
+        for batch in dataset.to_batches(
+            columns=columns, filter=self.__utc_filter(dataset), batch_size=rows
+        ):
+            if batch.num_rows == 0:
+                continue
+
+            yield {
+                chn: arrow_to_typed(chn, batch.column(i))
+                for i, chn in enumerate(batch.schema.names)
+            }
+
+    def __sidecar_blocks(self, rows: int, row_count: int) -> Iterator[dict]:
+        # Read from the column files, the pages of the mapped ones would stay resident
+        for start in range(0, row_count, rows):
+            yield {
+                chn: np.fromfile(
+                    col.filename,
+                    dtype=col.dtype,
+                    count=min(rows, row_count - start),
+                    offset=col.offset + start * col.itemsize,
+                )
+                for chn, col in self.data.items()
+            }
+
+    def __csv_blocks(self, rows: int) -> Iterator[dict]:
+        with open(self.filename, "r") as file:
+            titles, dtype, usecols = self.__typed_header(file)
+            self.var_count = len(titles)
+
+            while True:
+                lines = list(islice(file, rows))
+                if len(lines) == 0:
+                    break
+
+                try:
+                    block = load_typed(lines, dtype, usecols)
+                except ValueError:
+                    block = load_typed(lines, dtype, usecols, tolerant=True)
+
+                yield {t: block[t] for t in titles}
+
+    def __fused_blocks(self, blocks: Iterator[dict]) -> Iterator[dict]:
+        """
+        Yield the blocks with their sub-second times rebuilt. The last rows
+        of a block can be held back until the next one is read (see fuse_ms).
+        """
+        state = {}
+        for block in blocks:
+            block = self.__fuse_ms(block, state, final=False)
+            if block_rows(block) > 0:
+                yield block
+
+        block = self.__fuse_ms({}, state)
+        if block_rows(block) > 0:
+            yield block
+
+    def __fuse_ms(self, block: dict, state: dict, final: bool = True) -> dict:
+        """
+        Replace the whole second UTC times of a block of typed data with
+        the sub-second times rebuilt from CHN_MS (see fuse_ms), if
+        subsecond is set and the column exists.\n
+        'state' carries the reconstruction between consecutive blocks,
+        including the rows held back from the previous block.
+        """
+        pending = state.pop("pending", None)
+        if pending is not None:
+            block = (
+                {chn: np.concatenate((pending[chn], block[chn])) for chn in pending}
+                if block
+                else pending
+            )
+
+        if not self.subsecond or CHN_MS not in block or CHN_UTC not in block:
+            return block
+
+        fused = fuse_ms(block[CHN_UTC], block[CHN_MS], state, final)
+        done = len(fused)
+        if done < block_rows(block):
+            state["pending"] = {chn: col[done:] for chn, col in block.items()}
+
+        block = {chn: col[:done] for chn, col in block.items()}
+        block[CHN_UTC] = fused
+        return block
+
+    def get_columnar_data(self) -> dict:
+        """
+        Read the required columns of a Parquet or Arrow file into typed
+        arrays. Only the row groups that can hold rows within utc_range
+        are read.
+        """
+        self.setup_check()
+
+        dataset, columns = self.__dataset()
+        table = dataset.to_table(columns=columns, filter=self.__utc_filter(dataset))
+
+        self.var_count = table.num_columns
+        self.row_count = table.num_rows
+
+        return {chn: arrow_to_typed(chn, table.column(chn)) for chn in table.column_names}
+
+    def __dataset(self):
+        """
+        Return the pyarrow dataset of the file and the names of the columns to read
+        """
+        import pyarrow.dataset as pa_ds
+
+        dataset = pa_ds.dataset(self.filename, format=self.format)
+        return dataset, self.__read_columns(dataset.schema.names)
+
+    def __utc_filter(self, dataset):
+        """
+        Return the pyarrow filter expression for utc_range, None if there is no range.\n
+        The time column can be stored as timestamps or as ISO formatted strings.
+        """
+        if self.utc_range is None:
+            return None
+
+        import pyarrow as pa
+        import pyarrow.dataset as pa_ds
+
+        t_type = dataset.schema.field(CHN_UTC).type
+        field = pa_ds.field(CHN_UTC)
+
+        def bound(t):
+            t = np.datetime64(t, "ms")
+            if pa.types.is_timestamp(t_type):
+                return pa.scalar(t, type=pa.timestamp("ms")).cast(t_type)
+            # ISO strings compare in the same order as the times they represent
+            t = t.astype(object)
+            return t.isoformat(sep=" ", timespec="milliseconds" if t.microsecond else "seconds")
+
+        start, end = self.utc_range
+        if self.subsecond and CHN_MS in dataset.schema.names:
+            # Rebuilt times are up to a second after the stored ones, and
+            # depend on the rows within FUSE_WINDOW_MS of them
+            margin = np.timedelta64(1000 + FUSE_WINDOW_MS, "ms")
+            start = None if start is None else np.datetime64(start, "ms") - margin
+            end = None if end is None else np.datetime64(end, "ms") + margin
+
+        expr = None
+        if start is not None:
+            expr = field >= bound(start)
+        if end is not None:
+            expr = (field <= bound(end)) if expr is None else (expr & (field <= bound(end)))
+
+        return expr
+
+    def __utc_slice(self, utc: np.ndarray) -> slice:
+        """
+        Return the slice of the rows within utc_range, rows are ordered by time
+        """
+        start, end = self.utc_range
+        lo = 0 if start is None else np.searchsorted(utc, np.datetime64(start, "ms"), "left")
+        hi = len(utc) if end is None else np.searchsorted(utc, np.datetime64(end, "ms"), "right")
+
+        return slice(int(lo), int(max(lo, hi)))
+
+    def load_sidecar(self) -> dict:
+        """
+        Return the required columns memory mapped from the sidecar cache.\n
+        Returns an empty dict if the sidecar doesn't exist, belongs to another
+        version of the file, or lacks any of the required columns.
+        """
+        manifest = self.__sidecar_manifest()
+        if manifest is None:
+            return {}
+
+        columns = self.__read_columns(manifest["titles"])
+        if any(chn not in manifest["columns"] for chn in columns):
+            return {}
+
+        data = {}
+        for chn in columns:
+            fn = os.path.join(self.sidecar_dir, manifest["columns"][chn])
+            data[chn] = np.load(fn, mmap_mode="r")
+
+        self.var_count = len(data)
+        self.row_count = manifest["rows"]
+
+        Print("debug0", f"Mapped {len(data)} columns from {self.sidecar_dir}")
+        return data
+
+    def write_sidecar(self):
+        """
+        Store the typed columns in self.data in the sidecar cache, one .npy
+        file per column plus a manifest. Columns already cached are kept.
+        """
+        self.setup_check()
+
+        manifest = self.__sidecar_manifest()
+        if manifest is None:
+            with open(self.filename, "r") as file:
+                titles = [t.strip() for t in next(csv.reader([file.readline()]), [])]
+
+            stat = os.stat(self.filename)
+            manifest = {
+                "version": SIDECAR_VERSION,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "hash": file_hash(self.filename),
+                "rows": self.row_count,
+                "titles": titles,
+                "columns": {},
+            }
+
+        os.makedirs(self.sidecar_dir, exist_ok=True)
+
+        for chn, col in self.data.items():
+            if chn in manifest["columns"]:
+                continue
+
+            # Object columns can't be memory mapped, store them as fixed width strings
+            col = np.ascontiguousarray(col.astype(str) if col.dtype == object else col)
+
+            # Named after the column, so other processes caching it write the same file
+            name = f"col_{hashlib.blake2b(chn.encode(), digest_size=8).hexdigest()}.npy"
+            fn = os.path.join(self.sidecar_dir, name)
+            tmp = f"{fn}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as file:
+                np.save(file, col)
+            os.replace(tmp, fn)
+
+            manifest["columns"][chn] = name
+
+        # Keep the columns cached by other processes meanwhile
+        current = self.__sidecar_manifest()
+        if current is not None and current["hash"] == manifest["hash"]:
+            manifest["columns"] = {**current["columns"], **manifest["columns"]}
+
+        self.__write_manifest(manifest)
+
+    def __sidecar_manifest(self) -> dict:
+        """
+        Return the manifest of the sidecar if it is valid for the current
+        contents of the file, None otherwise.\n
+        Size and mtime are checked first, the contents hash is only computed
+        when the mtime changed.
+        """
+        fn = os.path.join(self.sidecar_dir, "manifest.json")
+        try:
+            with open(fn, "r") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        stat = os.stat(self.filename)
+        if manifest.get("version") != SIDECAR_VERSION or manifest.get("size") != stat.st_size:
+            return None
+
+        if manifest.get("mtime_ns") != stat.st_mtime_ns:
+            if manifest.get("hash") != file_hash(self.filename):
+                return None
+
+            # Same contents (e.g. file copied or touched)
+            manifest["mtime_ns"] = stat.st_mtime_ns
+            self.__write_manifest(manifest)
+
+        return manifest
+
+    def __write_manifest(self, manifest: dict):
+        fn = os.path.join(self.sidecar_dir, "manifest.json")
+        tmp = f"{fn}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(tmp, fn)
+
+    def __typed_header(self, file) -> Tuple[List[str], list, List[int]]:
+        """
+        Read the header of the open csv file and return the names, dtype and
+        file indices of the columns to read in typed mode.
+        The file is left at the first data row.
+        """
+        titles = [t.strip() for t in next(csv.reader([file.readline()]), [])]
+        usecols = self.__projection(titles)
+
+        start = file.tell()
+        first_row = next(csv.reader([file.readline()]), [])
+        first_row = first_row + [""] * (len(titles) - len(first_row))
+        file.seek(start)
+
+        titles = [titles[i] for i in usecols]
+        dtype = [(t, col_dtype(t, first_row[i])) for t, i in zip(titles, usecols)]
+
+        return titles, dtype, usecols
+
+    def __projection(self, titles: List[str]) -> List[int]:
+        """
+        Return the indices of the columns in 'titles' that have to be read
+        """
+        columns = self.__read_columns(titles)
+        return [i for i, t in enumerate(titles) if t in columns]
+
+    def __read_columns(self, titles: List[str]) -> List[str]:
+        """
+        Return the names of the columns to read, out of the ones in the file.\n
+        Those are the required columns, plus CHN_MS (if it exists) when
+        sub-second times are rebuilt.
+        """
+        if self.columns is None:
+            return list(titles)
+
+        for chn in self.columns:
+            if chn not in titles:
+                raise Exception(f'Column "{chn}" does not exist in "{self.filename}".')
+
+        columns = list(self.columns)
+        if self.subsecond and CHN_MS in titles and CHN_MS not in columns:
+            columns.append(CHN_MS)
+
+        return [t for t in titles if t in columns]
+
     def read_csv(self) -> Tuple[List[str], list]:
         self.setup_check()
 
@@ -77,13 +545,15 @@ class PosData:
         fn = self.filename
         with open(fn, "r") as file:  # TODO: Implement proper file locations
             reader = csv.reader(file)
-            i = 0
-            for row in reader:
-                if i == 0:
-                    titles = row
-                else:
-                    data.append(row)
-                i += 1
+            titles = [t.strip() for t in next(reader, [])]
+            usecols = self.__projection(titles)
+
+            if len(usecols) == len(titles):
+                data = list(reader)
+            else:
+                # Only keep the cells of the projected columns
+                titles = [titles[i] for i in usecols]
+                data = [[row[i] for i in usecols] for row in reader]
 
         # Debug(f'name of file: {self.filename}')
         # Debug(f'amount of variables: {len(titles)}')
@@ -129,7 +599,30 @@ class PosData:
         self.setup_check()
 
         # TODO: make the column names more flexible
-        return self.get_col(CHN_UTC)[0]
+        if len(self.data) == 0 or self.chunk_rows > 0:
+            # Streamed data, from its first block
+            first = next(self.iter_chunks())[CHN_UTC][0]
+        else:
+            first = self.get_col(CHN_UTC)[0]
+
+        if self.typed:
+            return first.astype("datetime64[us]").item().isoformat(sep=" ")
+        return first
+
+    def get_first_position(self) -> Tuple[float, float]:
+        """
+        Returns the latitude and longitude of the first row of the data
+        """
+        self.setup_check()
+
+        if len(self.data) == 0 or self.chunk_rows > 0:
+            # Streamed data, from its first block
+            first = next(self.iter_chunks())
+            lat, lon = first[CHN_LAT][0], first[CHN_LON][0]
+        else:
+            lat, lon = self.get_col(CHN_LAT)[0], self.get_col(CHN_LON)[0]
+
+        return float(lat), float(lon)
 
     def print_titles(self):
         self.setup_check()
@@ -140,11 +633,247 @@ class PosData:
         print()
 
 
+def col_dtype(name: str, sample: str):
+    """
+    Return the type used for a column in typed mode, based on its name
+    or on a sample value from it.
+    """
+    if name in CHN_TYPES:
+        return CHN_TYPES[name]
+
+    try:
+        float(sample)
+        return np.float64
+    except ValueError:
+        return object
+
+
+def to_float_or_nan(value: str) -> float:
+    return float(value) if value.strip() else np.nan
+
+
+def arrow_to_typed(name: str, column) -> np.ndarray:
+    """
+    Convert a pyarrow (chunked) array into a NumPy array, with the type
+    from CHN_TYPES for the known columns.
+    """
+    values = column.to_numpy(zero_copy_only=False)
+    if name in CHN_TYPES:
+        values = values.astype(CHN_TYPES[name], copy=False)
+    return values
+
+
+def block_rows(block: dict) -> int:
+    """
+    Return the number of rows of a block of columns
+    """
+    return len(next(iter(block.values()))) if block else 0
+
+
+def fuse_ms(utc: np.ndarray, ms: np.ndarray, state: dict, final: bool = True) -> np.ndarray:
+    """
+    Rebuild millisecond UTC times from whole second UTC times and the
+    millisecond counter of the logger. Returns datetime64[ms] values.\n
+    Every row bounds the start time of the counter from below
+    (start >= utc - ms, as utc is truncated). The start time used for a row
+    is the tightest bound among the rows of its counter run (until the
+    counter restarts) within FUSE_WINDOW_MS of counter time of it, so the
+    result only depends on the rows around it, not on how they are split
+    in blocks.\n
+    'state' carries the reconstruction between consecutive blocks. If not
+    'final', the rows whose window goes past the end of the block aren't
+    returned (only the first len(result) rows are done), they must be given
+    again at the start of the next block.
+    """
+    utc = np.asarray(utc).astype("datetime64[ms]")
+    ms = np.round(np.asarray(ms, dtype=np.float64)).astype(np.int64)
+    if len(utc) == 0:
+        return utc
+
+    # The rows of the previous blocks within the window of the first ones
+    lower = np.concatenate((state.get("lower", []), utc.astype(np.int64) - ms)).astype(np.int64)
+    ms = np.concatenate((state.get("ms", []), ms)).astype(np.int64)
+    c = len(ms) - len(utc)
+
+    # Runs of the counter, a new one starts where the counter goes back
+    run = np.cumsum(np.concatenate(([0], ms[1:] < ms[:-1])))
+
+    # Window of every row, within its run
+    key = run * (ms.max() - ms.min() + 2 * FUSE_WINDOW_MS + 1) + ms
+    first = np.searchsorted(key, key - FUSE_WINDOW_MS, "left")
+    last = np.searchsorted(key, key + FUSE_WINDOW_MS, "right") - 1
+
+    done = len(ms)
+    if not final:
+        # Rows of the last run whose window isn't complete yet
+        waiting = (run == run[-1]) & (ms + FUSE_WINDOW_MS >= ms[-1])
+        done = int(np.argmax(waiting))
+    if done <= c:
+        return utc[:0]
+
+    rows = slice(c, done)
+    fused = (window_max(lower, first[rows], last[rows]) + ms[rows]).astype("datetime64[ms]")
+    if "last_time" in state:
+        fused = np.maximum(fused, state["last_time"])
+    fused = np.maximum.accumulate(fused)
+
+    # Rows needed by the windows of the rows not done yet
+    keep = (run[:done] == run[done - 1]) & (ms[:done] >= ms[done - 1] - FUSE_WINDOW_MS)
+    state["lower"] = lower[:done][keep]
+    state["ms"] = ms[:done][keep]
+    state["last_time"] = fused[-1]
+
+    return fused
+
+
+def window_max(values: np.ndarray, first: np.ndarray, last: np.ndarray) -> np.ndarray:
+    """
+    Return the maximum of values[first[i] : last[i] + 1] for every i
+    """
+    length = last - first + 1
+
+    # levels[j][i] is the maximum of values[i : i + 2**j]
+    levels = [values]
+    while 2 ** len(levels) <= length.max():
+        half = 2 ** (len(levels) - 1)
+        levels.append(np.maximum(levels[-1][:-half], levels[-1][half:]))
+
+    # Two (overlapping) power of two ranges cover every window
+    level = np.floor(np.log2(length)).astype(np.int64)
+    result = np.empty(len(first), dtype=values.dtype)
+    for j in np.unique(level):
+        i = level == j
+        result[i] = np.maximum(levels[j][first[i]], levels[j][last[i] - 2**j + 1])
+
+    return result
+
+
+def load_typed(lines, dtype, usecols=None, tolerant=False) -> np.ndarray:
+    """
+    Parse csv rows (an open file or a list of lines, without the header)
+    into a structured array with the given dtype. If given, only the
+    columns at indices 'usecols' are converted.\n
+    If tolerant, empty cells in float64 columns are read as NaN (slower).
+    """
+    if usecols is None:
+        usecols = list(range(len(dtype)))
+
+    converters = None
+    if tolerant:
+        converters = {
+            usecols[i]: to_float_or_nan for i, (_, d) in enumerate(dtype) if d == np.float64
+        }
+
+    with warnings.catch_warnings():
+        # An empty input is a valid (empty) block
+        warnings.simplefilter("ignore", UserWarning)
+        return np.loadtxt(
+            lines,
+            delimiter=",",
+            quotechar='"',
+            dtype=dtype,
+            usecols=usecols,
+            converters=converters,
+            ndmin=1,
+        )
+
+
+def bench_projection(filename=POS_DATA_FOLDER / "test_data_full.csv", extra_cols=40, repeat=20):
+    """
+    Print the time and the stored bytes of reading a file with all columns
+    and with only CHN_DEFAULTS, in typed and in list of strings mode.\n
+    A temporary copy of 'filename' with 'extra_cols' additional numeric
+    channels (like the IMU, gimbal and battery ones in full flight logs)
+    is used.
+    """
+    with open(filename, "r") as src, tempfile.NamedTemporaryFile(
+        "w", suffix=".csv", delete=False
+    ) as dst:
+        header = src.readline().rstrip("\n").split(",")
+        header += [f"extra_{i}" for i in range(extra_cols)]
+        dst.write(",".join(header) + "\n")
+
+        for n, line in enumerate(src):
+            extra = ",".join(f"{n * i * 0.01:.3f}" for i in range(extra_cols))
+            dst.write(line.rstrip("\n") + "," + extra + "\n")
+
+    def stored_bytes(data: dict) -> int:
+        if len(data) and isinstance(next(iter(data.values())), np.ndarray):
+            return sum(col.nbytes for col in data.values())
+        return sum(sys.getsizeof(col) + sum(map(sys.getsizeof, col)) for col in data.values())
+
+    try:
+        for typed in (True, False):
+            for columns in (None, CHN_DEFAULTS):
+                now = time.perf_counter()
+                for _ in range(repeat):
+                    d = PosData(dst.name, typed=typed)
+                    d.setup(columns)
+                elapsed = (time.perf_counter() - now) / repeat
+
+                print(
+                    f"{'typed' if typed else 'lists'} {'projected' if columns else 'all cols '}:"
+                    f" {elapsed * 1000:8.2f} ms, {stored_bytes(d.data) / 1e3:10.1f} kB"
+                    f" ({d.var_count} of {len(header)} columns)"
+                )
+    finally:
+        os.remove(dst.name)
+
+
+def test_fuse_ms(filename=POS_DATA_FOLDER / "test_data_full.csv", sizes=(1, 7, 10, 11, 100)):
+    """
+    Check that fuse_ms() gives the same times whatever the blocks it is
+    given, on a synthetic log with a counter restart and on the streamed
+    positions of 'filename' (with and without a time range)
+    """
+    # 10 Hz log with jitter, the counter restarts halfway
+    rng = np.random.default_rng(0)
+    steps = rng.integers(90, 110, 400).astype("timedelta64[ms]")
+    true = np.datetime64("2021-04-05T12:00:00.370", "ms") + np.cumsum(steps)
+    ms = (true - true[0]).astype(np.int64)
+    ms[200:] = (true[200:] - true[200]).astype(np.int64) + 20
+    utc = true.astype("datetime64[s]")
+
+    whole = fuse_ms(utc, ms, {})
+    error = (true - whole).astype(np.int64)
+    assert ((error >= 0) & (error < 110)).all(), f"Error of {error.max()} ms"
+
+    for size in sizes:
+        state, fused = {}, []
+        rest_utc, rest_ms = utc[:0], ms[:0]
+        for i in range(0, len(utc), size):
+            block_utc = np.concatenate((rest_utc, utc[i : i + size]))
+            block_ms = np.concatenate((rest_ms, ms[i : i + size]))
+            fused.append(fuse_ms(block_utc, block_ms, state, final=False))
+            rest_utc, rest_ms = block_utc[len(fused[-1]) :], block_ms[len(fused[-1]) :]
+        fused.append(fuse_ms(rest_utc, rest_ms, state))
+        assert (np.concatenate(fused) == whole).all(), f"fuse_ms() differs in blocks of {size}"
+
+    with tempfile.TemporaryDirectory() as folder:
+        # A copy, streamed from the file and from its sidecar
+        copy = os.path.join(folder, os.path.basename(filename))
+        shutil.copyfile(filename, copy)
+        loaded = PosData(copy, typed=True, cache=True, subsecond=True)
+        loaded.setup()
+        times = loaded.data[CHN_UTC]
+        middle = (str(times[len(times) // 3]), str(times[2 * len(times) // 3]))
+
+        for utc_range, cache, size in product((None, middle), (False, True), sizes):
+            loaded = PosData(copy, typed=True, utc_range=utc_range, subsecond=True)
+            loaded.setup()
+            d = PosData(copy, chunk_rows=size, cache=cache, utc_range=utc_range, subsecond=True)
+            d.setup()
+            streamed = np.concatenate([block[CHN_UTC] for block in d.iter_chunks()])
+            assert (streamed == loaded.data[CHN_UTC]).all(), f"Times differ in blocks of {size}"
+
+    Info(f"Same sub-second times in blocks of {sizes} rows, with and without the sidecar")
+
+
 def test_run():
     print("Current dir:", os.getcwd())
     print()
 
-    test_file = POS_DATA_FOLDER + os.sep + "test_data.csv"
+    test_file = POS_DATA_FOLDER / "test_data_full.csv"
 
     d = PosData(test_file)
     d.setup()
@@ -159,6 +888,7 @@ def test_run():
 
 def main():
     test_run()
+    test_fuse_ms()
 
 
 if __name__ == "__main__":
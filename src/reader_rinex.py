@@ -17,10 +17,14 @@
 
 from xarray.core.dataarray import DataArray
 from xarray.core.dataset import Dataset
-from typing import Dict, Mapping, List, Tuple
+from typing import Callable, Dict, Mapping, List, Tuple
+from collections import OrderedDict
 import georinex as gr
 import datetime as dt
+import numpy as np
 import wget as wget
+import tempfile
+import json
 import time
 import os
 
@@ -28,81 +32,87 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 from common import *
 from d_print import Print, Debug
-from unavco.earthscope import get_earthscope_rinex, get_random_station
+from geometry import SatGeometry
+from ephemeris import Ephemeris, ChebyshevOrbits, PositionCube
+from rinex_catalog import RinexCatalog, rinex_catalog, rinex_file_name
+from unavco.earthscope import get_random_station, PREFETCH_WORKERS
+from unavco.stations import StationIndex, station_index
+from ephemeris_sources import EphemerisSource, EarthscopeSource
 
 # TODO: create directory if it doesn't exist
 # Directory where downloaded rinex files are stored
 # The sublist of the path removes the /src directory part
 R_FOLDER = os.path.dirname(os.path.abspath(__file__))[:-4] + "/rinex_files"
 
-# Required tolerance for the eccentricity anomaly error
-ECC_TOL = 0.001
-
 DEFAULT_STATIONS = ["ac70", "ab33", "ac15"]
 DL_MAX_TRIES = 5
+# Nearest stations tried first when the location is known (see set_location())
+NEAREST_STATIONS = 3
+
+# Satellite systems read from NAV files (the orbits are computed for GPS only)
+NAV_SYSTEMS = ["G"]
+NAV_CACHE_VERSION = 1
+CUBE_VERSION = 1
+
+# Days of NAV data kept in memory, and the hours around midnight in which
+# the NAV messages of the adjacent day are used too (half the usual fit interval)
+STORE_MAX_DAYS = 4
+STITCH_HOURS = 2
 
 
 class Satellite:
-    def __init__(self, prn: str, date: dt.date, gps_data: Dataset):
+    def __init__(self, prn: str, date: dt.date, gps_data: Ephemeris, store=None):
         self.prn = prn
         self.dates = [date]
         self.gps_data = {self.dates[0]: gps_data}
+        self.store: EphemerisStore = store  # Where the data of other dates is read from
         Print("debug0", f"Created Satellite object (PRN: {prn})")
-        Print("debug0", f'data: {self.gps_data[self.dates[0]]["time"]}')
+        Print("debug0", f"data: {gps_data.toe_count[0]} NAV messages")
 
     def get_position(self, times: List[dt.datetime] = []):
         if len(times) == 0:
             raise Exception("list of times cannot be empty.")
         mes_date = dt.date(times[0].year, times[0].month, times[0].day)
+        if mes_date not in self.dates and self.store is not None:
+            eph = self.store.get(mes_date)
+            if self.prn in eph.prns:
+                self.add_date(mes_date, eph.subset([self.prn]))
         if mes_date not in self.dates:
             raise Exception("Data for this date doesn't exist")
 
-        # Select the nearest recorded NAV message
-        close_nav = self.gps_data[mes_date].sel(time=times, method="nearest")
+        # Select the NAV message with the nearest time of ephemeris
+        eph = self.gps_data[mes_date]
+        times64 = np.array(times, dtype="datetime64[us]")
+        idx = eph.select(times64)
 
         Print("\\debug0", f"Satellite PRN: {self.prn}")
-        Print("\\debug0", f"NAV GPS message from times:")
-        for i in close_nav["time"].values:
-            Print("debug0", f"- {i}")
-
-        Print("\\debug0", f"Requested compute at times:")
-        for i in times:
-            Print("debug0", f"- {i}")
-
-        # Get the time of the NAV message
-        td = close_nav["time"].values.astype("datetime64[us]").astype(dt.datetime)
-
         Print(
             "\\debug0",
             f"Difference between NAV message and requested times (- before, + after NAV):",
         )
-        for i, j in zip(times, td):
-            dif = i - j
-            if dif < dt.timedelta(days=0):
-                Print("debug0", f" -{-dif}")
-            else:
-                Print("debug0", f" +{dif}")
+        for dif in eph.seconds(times64) - eph.toe[0, idx[:, 0]]:
+            Print("debug0", f" {'-' if dif < 0 else '+'}{dt.timedelta(seconds=abs(dif))}")
 
-        Print("\\0debug", f"After: {close_nav}")
-
-        ecef = gr.keplerian.keplerian2ecef(close_nav)
+        # Propagated to the requested times
+        ecef = eph.positions(times64, idx)[:, 0].T
 
         da = DataArray(list(ecef), dims=["space", "time"], coords=[["x", "y", "z"], times])
 
         return da
 
-    def add_date(self, datetime: dt.datetime, gps_data: Dataset):
-        if not self.has_date(datetime):
-            self.gps_data[datetime.date] = gps_data
+    def add_date(self, date: dt.date, gps_data: Ephemeris):
+        if not self.has_date(date):
+            self.dates.append(date)
+            self.gps_data[date] = gps_data
         else:
-            Print("debug", f"Data for {datetime.date} already exists.")
+            Print("debug", f"Data for {date} already exists.")
 
     def has_date(self, date: dt.date) -> bool:
         return date in self.gps_data.keys()
 
 
 class OrbitalData:
-    def __init__(self, utc: str = "1900-01-01 00:00:00"):
+    def __init__(self, utc: str = "1900-01-01 00:00:00", source: EphemerisSource = None):
         # Date parameters
         d_utc = dt.datetime.fromisoformat(utc)
         y_utc = d_utc.year
@@ -113,12 +123,23 @@ class OrbitalData:
         # File name parameters
         self.is_file_available = False
         self.station = DEFAULT_STATIONS[0]
-        self.rinex_file = f"{self.station}{self.gps_day}0.{self.gps_year}n.Z"
+        self.location: Tuple[float, float] = None  # (lat, lon) where the data is used
+        self.rinex_file = rinex_file_name(self.station, self.utc)
         self.filedir_remote = ""
         self.filedir_local = ""
+        # Where missing files are downloaded from
+        self.source = EarthscopeSource() if source is None else source
 
-        # Dict containing all satellite objects
+        # Dict containing the satellite objects made so far, see get_satellite()
         self.sats: Dict[str, Satellite] = {}
+        # NAV data of the days used so far (the most recent ones)
+        self.store = EphemerisStore(self.load_day)
+        # NAV messages of all satellites, stacked for the propagation
+        self.ephemeris: Ephemeris = None
+        # Optional Chebyshev fits of the orbits of the day, see precompute_orbits()
+        self.orbits: ChebyshevOrbits = None
+        # Optional memory mapped positions of the day, see use_position_cube()
+        self.cube: PositionCube = None
 
         self.done_setup = False
         self.debuging = "none"
@@ -161,7 +182,7 @@ class OrbitalData:
 
     def change_station(self, new_station: str):
         self.station = new_station
-        self.rinex_file = f"{self.station}{self.gps_day}0.{self.gps_year}n.Z"
+        self.rinex_file = rinex_file_name(self.station, self.utc)
         self.filedir_local = f"{RINEX_FOLDER}/{self.rinex_file}"
         self.is_file_available = False
 
@@ -174,39 +195,97 @@ class OrbitalData:
         self.utc = dt.date(self.utc.year, self.utc.month, self.utc.day)
         self.change_station(self.station)  # Update all filenames and directories
 
+    def set_location(self, lat: float, lon: float):
+        """
+        Set where the data is used (degrees), to download it from the nearest stations
+        """
+        self.location = (lat, lon)
+
+    def preferred_stations(self) -> List[str]:
+        """
+        Return the stations to read the file of the day from: the nearest
+        ones operating that day (if the location and the station metadata
+        are known), the current one and the default ones. Stations known to
+        miss the file of the day go last, and those that missed more files
+        than they had go after the rest, each group nearest first.
+        """
+        stations = []
+        index = station_index()
+        if index is not None and self.location is not None:
+            stations += index.nearest(*self.location, self.utc, k=NEAREST_STATIONS)
+        stations = list(dict.fromkeys(stations + [self.station] + DEFAULT_STATIONS))
+
+        catalog = rinex_catalog()
+        source = self.source.name()
+        counts = catalog.station_counts(source, "G")
+
+        def rank(station: str) -> Tuple[bool, bool]:
+            hits, misses = counts.get(station, (0, 0))
+            return catalog.is_missing(rinex_file_name(station, self.utc), source), misses > hits
+
+        return sorted(stations, key=rank)
+
     def local_file_exists(self) -> bool:
         self.setup_check()
 
         Print("debug0", f"local_file_exists()")
-        for file in os.listdir(RINEX_FOLDER):
-            # Check if file with same day exists
-            if file.endswith(self.rinex_file[4:]):
-                self.change_station(file[:4])
-                Print("debug0", f"File exists locally: {self.filedir_local}")
-                return True
-        return False
+        # File of the same day, from the preferred stations if there is one
+        found = rinex_catalog().find(
+            self.utc.year, self.gps_day, "G", prefer=self.preferred_stations()
+        )
+        if found is None:
+            return False
+
+        station, file = found
+        self.change_station(station)
+        self.rinex_file = file
+        self.filedir_local = f"{RINEX_FOLDER}/{self.rinex_file}"
+        Print("debug0", f"File exists locally: {self.filedir_local}")
+        return True
 
     def get_file(self) -> str:
         self.setup_check()
 
         Print("debug0", f"get_file()")
         if not self.local_file_exists():
+            # Failed transfers are retried with backoff by the source. Files
+            # known to be missing from the source aren't requested again until
+            # their record expires.
+            catalog = rinex_catalog()
+            source = self.source.name()
+
+            stations = self.preferred_stations()
             downloaded = False
+            candidate = 0
             tries = 0
             while not downloaded:
-                Print("info", f"Downloading...")
-
-                # If current station is unavailable at self.utc: try other stations
-                if 1 <= tries and tries < len(DEFAULT_STATIONS):
-                    self.change_station(DEFAULT_STATIONS[tries])
-                elif 1 <= tries:
+                # If a station is unavailable at self.utc: try the next ones
+                if candidate < len(stations):
+                    self.change_station(stations[candidate])
+                else:
                     self.change_station(get_random_station())
+                candidate += 1
+
+                if catalog.is_missing(self.rinex_file, source):
+                    Print("debug", f"{self.rinex_file} is known to be missing, skipped.")
+                    continue
 
                 if tries >= DL_MAX_TRIES:
                     raise Exception(f"Maximum download request attempts ({DL_MAX_TRIES}) reached.")
 
+                Print("info", f"Downloading...")
                 tries = tries + 1
-                downloaded = get_earthscope_rinex(self.rinex_file)
+                downloaded = self.source.fetch(self.rinex_file)
+                if downloaded is False:
+                    catalog.add_miss(self.rinex_file, source)
+                elif downloaded is None:
+                    # The source failed after its retries (e.g. no network),
+                    # the other stations would fail the same way
+                    raise Exception(
+                        f"Could not download {self.rinex_file}, the source is unavailable."
+                    )
+
+            catalog.add(self.rinex_file)
 
         self.is_file_available = True
         return f"{RINEX_FOLDER}/{self.rinex_file}"
@@ -220,52 +299,103 @@ class OrbitalData:
 
         # Read all the data from Rinex file
         Print("info0", f'Reading Rinex file "{self.rinex_file}"...')
-        nav = gr.load(self.filedir_local)
+        nav = load_nav(self.filedir_local)
 
+        # One pass over the arrays of the satellites in the file. The Dataset
+        # isn't kept, Satellite objects are made from these arrays when needed
         now = time.perf_counter()
-        # TODO: reset to normal operation (this is testing mode)
-        for n in range(1, nav["sv"].size + 1):
-            sat = "G" + f"{n:02}"
-            # p.Print('\\debug',f'Satellite: {sat}')
-
-            # Create or add data to Satellite object at date of self.utc
-            if sat not in self.sats.keys():
-                self.sats[sat] = Satellite(
-                    sat, self.utc, nav.sel(sv=sat).dropna(dim="time", how="all")
-                )
-            elif not self.sats[sat].has_date(self.utc):
-                self.sats[sat].add_date(self.utc, nav.sel(sv=sat).dropna(dim="time", how="all"))
-            else:
-                pass
+        self.ephemeris = Ephemeris(nav)
+        self.orbits = None
+        self.cube = None
+        self.store.put(self.utc, self.ephemeris)
+        del nav
 
-        Print("info\\0", f"Done. ({time.perf_counter()-now:.3f}s for {len(self.sats)} satellites)")
+        # Satellites already made get the data of the new date
+        for prn, sat in self.sats.items():
+            if prn in self.ephemeris.prns and not sat.has_date(self.utc):
+                sat.add_date(self.utc, self.ephemeris.subset([prn]))
 
-    def get_sats_pos(
-        self, time_list: List[dt.datetime]
-    ) -> Mapping[str, Mapping[str, Tuple[float, float, float]]]:
+        Print(
+            "info\\0",
+            f"Done. ({time.perf_counter()-now:.3f}s for {len(self.ephemeris.prns)} satellites)",
+        )
+
+    def load_day(self, day: dt.date) -> Ephemeris:
         """
-        Input a list of times for when to compute the positions of the satellites.
-        Inputs can be either ISO formatted strings or datetime objects.
+        Return the NAV data of another day, from its RINEX file (downloaded if needed)
+        """
+        if day == self.utc and self.ephemeris is not None:
+            return self.ephemeris
+
+        other = OrbitalData(source=self.source)
+        other.change_station(self.station)
+        other.location = self.location
+        other.setup(f"{day} 00:00:00")
+
+        return other.ephemeris
+
+    def get_satellite(self, prn: str) -> Satellite:
+        """
+        Return the Satellite object of a PRN, made on first use
         """
         self.setup_check()
 
-        Print("debug0", f"get_sats_pos()")
         if not self.is_file_available:
             self.read_rinex()
 
-        if len(self.sats) == 0:
-            Print(
-                "\\error\\",
-                f"[get_sats_pos] No Satellite objects in this instance (no file has been read yet)",
-            )
-            return
+        if prn not in self.ephemeris.prns:
+            raise Exception(f"No NAV data for satellite {prn} in {self.rinex_file}.")
+
+        if prn not in self.sats:
+            self.sats[prn] = Satellite(prn, self.utc, self.ephemeris.subset([prn]), self.store)
 
-        times = time_list.copy()
+        return self.sats[prn]
 
-        if len(times) != 0:
-            for i in range(len(times)):
-                if type(times[i]) == str:
-                    times[i] = dt.datetime.fromisoformat(times[i])
+    def precompute_orbits(self, **fit_args):
+        """
+        Fit the orbits of all satellites over the day with piecewise
+        Chebyshev polynomials (see ChebyshevOrbits for 'fit_args'). After
+        this, get_sats_pos evaluates the polynomials instead of solving the
+        Keplerian orbits.
+        """
+        self.setup_check()
+
+        now = time.perf_counter()
+        start = np.datetime64(self.utc, "us")
+        self.orbits = ChebyshevOrbits(
+            self.ephemeris, start, start + np.timedelta64(1, "D"), **fit_args
+        )
+
+        Print(
+            "debug0",
+            f"Fitted orbits in {time.perf_counter()-now:.3f}s ({self.orbits.error:.2e} m max error)",
+        )
+
+    def use_position_cube(self):
+        """
+        Map the positions of all satellites at every second of the day from
+        the cache next to the RINEX file (computed on first use). After this,
+        get_sats_pos interpolates them instead of solving the Keplerian orbits.
+        """
+        self.setup_check()
+
+        if not self.is_file_available:
+            self.read_rinex()
+
+        self.cube = open_position_cube(self.filedir_local, self.ephemeris, self.utc)
+
+    def get_sats_geometry(self, time_list: List[dt.datetime]) -> SatGeometry:
+        """
+        Return the positions of all satellites at every time of the list
+        (ISO formatted strings, datetime objects or datetime64 values).
+        """
+        self.setup_check()
+
+        Print("debug0", f"get_sats_geometry()")
+        if not self.is_file_available:
+            self.read_rinex()
+
+        times = np.array(time_list, dtype="datetime64[us]")
 
         now = time.perf_counter()
         Print(
@@ -273,28 +403,393 @@ class OrbitalData:
             f'Calculating satellite positions for "{self.utc.year}-{self.utc.month}-{self.utc.day}"...',
         )
 
-        results = {}
-        for t in time_list:
-            results[t] = {}
+        # All satellites at all times at once, (len(times), len(prns), 3)
+        own_day = (times.astype("datetime64[D]") == np.datetime64(self.utc)).all()
+        if own_day and (self.cube is not None or self.orbits is not None):
+            eph_idx = self.ephemeris.select(times)
+            if self.cube is not None:
+                xyz = self.cube.positions(times)
+            else:
+                xyz = self.orbits.positions(times)
 
-        # TODO: fix output format to: time{} -> prn{} = (x,y,z)
-        for prn in list(self.sats.keys()):
-            dr = self.sats[prn].get_position(times)
+            geometry = SatGeometry(times, self.ephemeris.prns, xyz)
+            stale = ~self.ephemeris.in_fit(times, eph_idx)
+        else:
+            # Any day, stitched with the adjacent days around midnight
+            geometry, in_fit = self.store.geometry(times)
+            stale = geometry.visible & ~in_fit
 
-            for t in times:
-                results[t.isoformat(sep=" ")][prn] = dr.sel(time=t).values
+        if stale.any():
+            Print(
+                "debug",
+                f"{stale.sum()} positions are outside the fit interval of their NAV message.",
+            )
 
         Print(
             "debug\\",
-            f"Done. ({time.perf_counter()-now:.3f}s for {len(self.sats)*len(times)} positions)",
+            f"Done. ({time.perf_counter()-now:.3f}s for {geometry.visible.sum()} positions)",
         )
 
+        return geometry
+
+    def get_sats_pos(
+        self, time_list: List[dt.datetime]
+    ) -> Mapping[str, Mapping[str, Tuple[float, float, float]]]:
+        """
+        Input a list of times for when to compute the positions of the satellites.
+        Inputs can be either ISO formatted strings or datetime objects.\n
+        Dict view of get_sats_geometry().
+        """
+        self.setup_check()
+
+        if self.ephemeris is None or len(self.ephemeris.prns) == 0:
+            Print(
+                "\\error\\",
+                f"[get_sats_pos] No satellite data in this instance (no file has been read yet)",
+            )
+            return
+
+        # Every distinct time is computed once, in order of appearance
+        keys = list(dict.fromkeys(time_list))
+
         # Output order is:  times{} -> prn{} = (x,y,z)
+        return self.get_sats_geometry(keys).to_dict(keys)
+
+
+class EphemerisStore:
+    def __init__(self, load_day: Callable[[dt.date], Ephemeris], max_days: int = STORE_MAX_DAYS):
+        """
+        NAV data of many days, read with 'load_day' when first needed. Only
+        the 'max_days' most recently used days are kept in memory.
+        """
+        self.load_day = load_day
+        self.max_days = max_days
+        self.days: Dict[dt.date, Ephemeris] = OrderedDict()
+        self.missing = set()  # Days that couldn't be read, not tried again
+
+    def put(self, day: dt.date, eph: Ephemeris):
+        self.days[day] = eph
+        self.days.move_to_end(day)
+
+        while len(self.days) > self.max_days:
+            old, _ = self.days.popitem(last=False)
+            Print("debug0", f"Released NAV data of {old}")
+
+    def get(self, day: dt.date) -> Ephemeris:
+        if day in self.days:
+            self.days.move_to_end(day)
+        else:
+            self.put(day, self.load_day(day))
 
-        return results
+        return self.days[day]
+
+    def stitched(self, day: dt.date, times: np.ndarray) -> Ephemeris:
+        """
+        Return the NAV data of 'day' for 'times' within it. If some times are
+        within STITCH_HOURS of midnight, the messages of the adjacent day are
+        added, so the nearest message can be from that day.
+        """
+        parts = [self.get(day)]
+
+        start = np.datetime64(day, "us")
+        margin = np.timedelta64(STITCH_HOURS, "h")
+        one_day = dt.timedelta(days=1)
+        for other, near in (
+            (day - one_day, times.min() < start + margin),
+            (day + one_day, times.max() >= start + np.timedelta64(1, "D") - margin),
+        ):
+            if not near or other in self.missing:
+                continue
+            try:
+                parts.append(self.get(other))
+            except Exception as e:
+                self.missing.add(other)
+                Print("debug", f"NAV data of {other} is not available, not stitched ({e})")
+
+        return Ephemeris.merge(parts) if len(parts) > 1 else parts[0]
+
+    def geometry(self, times: np.ndarray) -> Tuple[SatGeometry, np.ndarray]:
+        """
+        Return the positions of the satellites at 'times' (of any days), and
+        the mask of the ones computed within the fit interval of their NAV
+        message. Satellites without NAV data at a time are not visible.
+        """
+        days = times.astype("datetime64[D]")
+
+        # Day by day, so only the days around the one processed need to be in memory
+        results = []
+        for day in np.unique(days):
+            rows = np.flatnonzero(days == day)
+            eph = self.stitched(day.item(), times[rows])
+            idx = eph.select(times[rows])
+            results.append(
+                (rows, eph.prns, eph.positions(times[rows], idx), eph.in_fit(times[rows], idx))
+            )
+
+        prns = sorted(set().union(*[r[1] for r in results]))
+        index = {prn: i for i, prn in enumerate(prns)}
+
+        xyz = np.full((len(times), len(prns), 3), np.nan)
+        visible = np.zeros((len(times), len(prns)), dtype=bool)
+        in_fit = np.zeros((len(times), len(prns)), dtype=bool)
+        for rows, day_prns, day_xyz, day_fit in results:
+            cells = np.ix_(rows, [index[prn] for prn in day_prns])
+            xyz[cells] = day_xyz
+            visible[cells] = True
+            in_fit[cells] = day_fit
+
+        return SatGeometry(times, prns, xyz, visible), in_fit
+
+
+def prefetch_rinex(
+    days: List[dt.date],
+    stations: List[str] = DEFAULT_STATIONS,
+    max_workers: int = PREFETCH_WORKERS,
+    source: EphemerisSource = None,
+) -> Dict[dt.date, str]:
+    """
+    Download at the same time the NAV files of all 'days' (e.g. of a batch
+    of flights) that aren't in RINEX_FOLDER yet, from the first station of
+    'stations' that has them in 'source' (the Earthscope archive if not
+    given). Returns the file of every day (None if none of the stations has it).
+    """
+    source = EarthscopeSource() if source is None else source
+    catalog = rinex_catalog()
+    files = {day: None for day in days}
+
+    for day in files:
+        found = catalog.find(day.year, day.timetuple().tm_yday, "G", prefer=stations)
+        if found is not None:
+            files[day] = found[1]
+
+    # One round of downloads per station, for the days still missing (except
+    # the files known to be missing upstream)
+    for station in stations:
+        missing = {
+            rinex_file_name(station, day): day for day, file in files.items() if file is None
+        }
+        missing = {
+            file: day
+            for file, day in missing.items()
+            if not catalog.is_missing(file, source.name())
+        }
+        if not missing:
+            continue
+
+        Print("info", f"Downloading {len(missing)} files from {station}...")
+        done = source.fetch_many(missing, RINEX_FOLDER, max_workers)
+        for file, downloaded in done.items():
+            if downloaded:
+                catalog.add(file)
+                files[missing[file]] = file
+            elif downloaded is False:
+                catalog.add_miss(file, source.name())
+
+        if all(downloaded is None for downloaded in done.values()):
+            # The source failed after its retries (e.g. no network), the other stations would too
+            Print("info", f"The source is unavailable, {len(missing)} files not downloaded.")
+            break
+
+    return files
+
+
+def load_nav(filename: str, use: List[str] = NAV_SYSTEMS) -> Dataset:
+    """
+    Return the NAV data of the satellite systems 'use' in a RINEX file.
+    The parsed data is cached in NAV_CACHE_DIR, so the file is only
+    decompressed and parsed once.
+    """
+    nav = read_nav_cache(filename, use)
+    if nav is None:
+        nav = gr.load(filename, use=set(use))
+        write_nav_cache(filename, nav, use)
+
+    return nav
+
+
+def nav_cache_file(filename: str) -> str:
+    return os.path.join(NAV_CACHE_DIR, os.path.basename(filename) + ".npz")
+
+
+def read_nav_cache(filename: str, use: List[str] = NAV_SYSTEMS) -> Dataset:
+    """
+    Return the cached NAV data of a RINEX file, None if it isn't cached, was
+    cached by another version, or the file changed since.\n
+    Size and mtime are checked first, the contents hash is only computed
+    when the mtime changed.
+    """
+    try:
+        with np.load(nav_cache_file(filename), allow_pickle=False) as cached:
+            meta = json.loads(str(cached["meta"]))
+
+            if meta.get("version") != NAV_CACHE_VERSION or meta.get("use") != sorted(use):
+                return None
+            if not same_source(meta, filename):
+                return None
+
+            data_vars = {v: (tuple(dims), cached[f"var_{v}"]) for v, dims in meta["vars"].items()}
+            coords = {c: cached[f"coord_{c}"] for c in meta["coords"]}
+    except (OSError, KeyError, ValueError):
+        return None
+
+    Print("debug0", f"Read cached NAV data of {filename}")
+    return Dataset(data_vars, coords=coords, attrs=meta["attrs"])
+
+
+def write_nav_cache(filename: str, nav: Dataset, use: List[str] = NAV_SYSTEMS):
+    """
+    Store the NAV data of a RINEX file in NAV_CACHE_DIR, with the size, mtime
+    and contents hash of the file to detect when it changes.
+    """
+    meta = {
+        "version": NAV_CACHE_VERSION,
+        **source_meta(filename),
+        "use": sorted(use),
+        "vars": {v: list(nav[v].dims) for v in nav.data_vars},
+        "coords": list(nav.coords),
+        # Attributes that aren't JSON types (e.g. numpy values) are stored as strings
+        "attrs": json.loads(json.dumps(nav.attrs, default=str)),
+    }
+
+    arrays = {f"var_{v}": nav[v].values for v in nav.data_vars}
+    arrays.update({f"coord_{c}": nav[c].values for c in nav.coords})
+
+    os.makedirs(NAV_CACHE_DIR, exist_ok=True)
+    fn = nav_cache_file(filename)
+    tmp = f"{fn}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as file:
+        np.savez(file, meta=json.dumps(meta), **arrays)
+    os.replace(tmp, fn)
+
+
+def source_meta(filename: str) -> dict:
+    """
+    Return the size, mtime and contents hash of a file that cached data is made from
+    """
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": file_hash(filename)}
+
+
+def same_source(meta: dict, filename: str) -> bool:
+    """
+    Check if cached data with 'meta' (see source_meta) was made from the
+    current contents of a file. The hash is only computed if the mtime changed.
+    """
+    stat = os.stat(filename)
+    if meta.get("size") != stat.st_size:
+        return False
+
+    return meta.get("mtime_ns") == stat.st_mtime_ns or meta.get("hash") == file_hash(filename)
+
+
+def cube_files(filename: str) -> Tuple[str, str]:
+    """
+    Return the names of the position cube of a RINEX file and of its manifest
+    """
+    fn = os.path.join(NAV_CACHE_DIR, os.path.basename(filename) + ".cube")
+    return fn + ".npy", fn + ".json"
+
+
+def open_position_cube(filename: str, eph: Ephemeris, day) -> PositionCube:
+    """
+    Return the memory mapped position cube of a RINEX file for 'day'. It is
+    computed from 'eph' (the NAV data of the file) if it doesn't exist, was
+    made by another version, or the file changed since.
+    """
+    cube_fn, manifest_fn = cube_files(filename)
+    day = np.datetime64(day, "D")
+
+    try:
+        with open(manifest_fn, "r") as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        meta = {}
+
+    valid = (
+        meta.get("version") == CUBE_VERSION
+        and meta.get("day") == str(day)
+        and meta.get("prns") == eph.prns
+        and os.path.exists(cube_fn)
+        and same_source(meta, filename)
+    )
+
+    if not valid:
+        now = time.perf_counter()
+        os.makedirs(NAV_CACHE_DIR, exist_ok=True)
+        PositionCube.write(cube_fn, eph, day)
+
+        meta = {"version": CUBE_VERSION, **source_meta(filename), "day": str(day), "prns": eph.prns}
+        tmp = f"{manifest_fn}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp, manifest_fn)
+
+        Print("debug0", f"Computed position cube in {time.perf_counter()-now:.3f}s")
+
+    return PositionCube(cube_fn, eph, day)
+
+
+def test_preferred_stations():
+    """
+    Check that the nearest stations are tried first, then the current and
+    the default ones, with the stations missing the file of the day last and
+    those that missed more files than they had before them
+    """
+    meta = {
+        "ab01": {"lat": 60.0, "lon": 24.0, "start": "2004-01-01", "end": None},
+        "ab02": {"lat": 60.5, "lon": 24.0, "start": "2004-01-01", "end": None},
+        "ab04": {"lat": 61.0, "lon": 24.0, "start": "2004-01-01", "end": None},
+        "ab06": {"lat": 61.5, "lon": 24.0, "start": "2004-01-01", "end": None},
+        "ab07": {"lat": 60.1, "lon": 24.0, "start": "2004-01-01", "end": "2010-12-31"},
+    }
+    import rinex_catalog as catalog_module
+    import unavco.stations as stations_module
+
+    saved = catalog_module._catalog, stations_module._index, stations_module._index_loaded
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            # In its own folder like CATALOG_FILE, so writing it doesn't change the one scanned
+            catalog = RinexCatalog(folder, os.path.join(folder, "cache", "catalog.json"))
+            catalog_module._catalog = catalog
+            stations_module._index, stations_module._index_loaded = StationIndex(meta), True
+
+            o = OrbitalData("2019-07-04 10:00:00")
+            source = o.source.name()
+            defaults = list(dict.fromkeys([o.station] + DEFAULT_STATIONS))
+            assert o.preferred_stations() == defaults, "Stations tried without a location"
+
+            # ab07 was removed before the day
+            o.set_location(60.1, 24.0)
+            assert o.preferred_stations() == ["ab01", "ab02", "ab04"] + defaults
+
+            # Missing the file of the day, and more misses than files (the
+            # counts are cached until the catalog is written)
+            catalog.add_miss(rinex_file_name("ab01", o.utc), source)
+            for days in (1, 2):
+                catalog.add_miss(rinex_file_name("ab02", o.utc - dt.timedelta(days)), source)
+            assert o.preferred_stations() == ["ab04"] + defaults + ["ab02", "ab01"]
+            assert catalog.station_counts(source)["ab02"] == (0, 2)
+            assert catalog.station_counts(source) is catalog.station_counts(source)
+
+            # Files found again outweigh the misses
+            for days in (3, 4, 5):
+                name = rinex_file_name("ab02", o.utc - dt.timedelta(days))
+                open(os.path.join(folder, name), "wb").close()
+                catalog.add(name)
+            assert catalog.station_counts(source)["ab02"] == (3, 2)
+            assert o.preferred_stations() == ["ab02", "ab04"] + defaults + ["ab01"]
+            assert catalog.is_missing(rinex_file_name("ab01", o.utc), source)
+            assert not catalog.is_missing(rinex_file_name("ab01", o.utc), "mirror")
+        finally:
+            catalog_module._catalog = saved[0]
+            stations_module._index, stations_module._index_loaded = saved[1:]
+
+    Print("info", "Stations ranked by distance, misses of the day and past misses")
 
 
 if __name__ == "__main__":
+    test_preferred_stations()
+
     o = OrbitalData("2019-07-10 07:25:31")
     o.setup()
     o.print_data()
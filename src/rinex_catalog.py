@@ -0,0 +1,376 @@
+###############################################################################
+# Gdoper                                                                      #
+#                                                                             #
+# File:  rinex_catalog.py
+#
+# Description:
+# Catalog of the RINEX files stored in RINEX_FOLDER, indexed by year, day of
+# year and satellite system, so finding the file of a day doesn't list the
+# whole folder. It also records the files that don't exist upstream, so they
+# aren't requested again for a while.
+#                                                                             #
+###############################################################################
+
+from typing import Dict, List, Tuple
+import threading
+import datetime as dt
+import tempfile
+import json
+import time
+import re
+import os
+
+from common import *
+from d_print import Print
+
+CATALOG_FILE = os.path.join(NAV_CACHE_DIR, "catalog.json")
+CATALOG_VERSION = 3
+
+# Seconds a missing file isn't requested again. Files of the last days may
+# still be published, so their misses expire sooner.
+MISS_TTL = 7 * 86400
+MISS_TTL_RECENT = 3600
+MISS_RECENT_DAYS = 3
+
+# Daily NAV file names: station, day of year, year and type of file
+RINEX_NAME = re.compile(r"^(\w{4})(\d{1,3})0\.(\d{2})([neg])\.Z$")
+# Satellite system of every type of NAV file
+RINEX_SYSTEMS = {"n": "G", "g": "R", "e": "E"}
+SYSTEM_TYPES = {system: kind for kind, system in RINEX_SYSTEMS.items()}
+
+
+def rinex_name(station: str, year: int, day: int, system: str = "G") -> str:
+    """
+    Return the name of the daily NAV file of a station (day of year 'day')
+    """
+    return f"{station}{day:03d}0.{year % 100:02d}{SYSTEM_TYPES[system]}.Z"
+
+
+def rinex_file_name(station: str, day: dt.date) -> str:
+    """
+    Return the name of the daily GPS NAV file of a station
+    """
+    return rinex_name(station, day.year, day.timetuple().tm_yday)
+
+
+def parse_rinex_name(name: str) -> Tuple[str, int, int, str]:
+    """
+    Return the station, year, day of year and satellite system of a daily
+    NAV file name, None if it isn't one
+    """
+    matches = RINEX_NAME.match(name)
+    if matches is None:
+        return None
+
+    station, day, year, kind = matches.groups()
+    return station, 2000 + int(year), int(day), RINEX_SYSTEMS[kind]
+
+
+class RinexCatalog:
+    def __init__(self, folder: str = RINEX_FOLDER, filename: str = CATALOG_FILE):
+        """
+        Catalog of the NAV files of 'folder', stored in 'filename'. It is
+        rebuilt from the folder only when the folder changed (by its mtime),
+        e.g. files copied or deleted by hand, or downloaded by another process.\n
+        Files missing from a source are kept until their TTL expires, and
+        shared with other processes through the catalog file.
+        """
+        self.folder = str(folder)
+        self.filename = str(filename)
+        self.lock = threading.Lock()
+
+        # {"year/day/system": {station: file name}}
+        self.files: Dict[str, Dict[str, str]] = {}
+        self.mtime_ns = None
+        # {source: {"year/day/system": {station: [recorded, expires]}}}, unix
+        # times. Files found again are recorded with expires 0, so the newest
+        # record wins when merging the misses of other processes.
+        self.misses: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
+        # {(source, system): (station_counts(), time they are valid until)},
+        # cleared whenever the files or the misses change
+        self.counts: Dict[Tuple[str, str], Tuple[dict, float]] = {}
+        # (inode, mtime) of the catalog file when last read or written. Every
+        # write replaces the file, so writes in the same clock tick differ too
+        self.file_id = None
+
+        catalog = self.__read()
+        if catalog is not None:
+            self.files = catalog["files"]
+            self.mtime_ns = catalog["mtime_ns"]
+            self.misses = catalog["misses"]
+
+    @staticmethod
+    def key(year: int, day: int, system: str = "G") -> str:
+        return f"{year}/{day:03d}/{system}"
+
+    def find(
+        self, year: int, day: int, system: str = "G", prefer: List[str] = []
+    ) -> Tuple[str, str]:
+        """
+        Return the station and the file name of the NAV file of a day, from
+        the first station of 'prefer' that has it, or any station otherwise.
+        None if there is no file of that day.
+        """
+        with self.lock:
+            self.__refresh()
+            stations = self.files.get(self.key(year, day, system), {})
+
+        for station in prefer:
+            if station in stations:
+                return station, stations[station]
+        if stations:
+            station = min(stations)
+            return station, stations[station]
+
+        return None
+
+    def add(self, name: str):
+        """
+        Add a file just stored in the folder (e.g. downloaded)
+        """
+        station, year, day, system = self.__parse(name)
+        with self.lock:
+            self.__refresh()
+            self.files.setdefault(self.key(year, day, system), {})[station] = name
+            # No longer missing from any source
+            self.__sync()
+            now = time.time()
+            for days in self.misses.values():
+                if station in days.get(self.key(year, day, system), {}):
+                    days[self.key(year, day, system)][station] = [now, 0]
+            self.__write()
+
+    def add_miss(self, name: str, source: str):
+        """
+        Record that a file doesn't exist in a source (EphemerisSource.name())
+        """
+        station, year, day, system = self.__parse(name)
+
+        now = time.time()
+        age = dt.date.today() - (dt.date(year, 1, 1) + dt.timedelta(days=day - 1))
+        expires = now + (MISS_TTL_RECENT if age.days <= MISS_RECENT_DAYS else MISS_TTL)
+        with self.lock:
+            self.__sync()
+            days = self.misses.setdefault(source, {})
+            days.setdefault(self.key(year, day, system), {})[station] = [now, expires]
+            self.__write()
+
+    def is_missing(self, name: str, source: str) -> bool:
+        """
+        Return True if the file is known not to exist in a source (and the record didn't expire)
+        """
+        station, year, day, system = self.__parse(name)
+        with self.lock:
+            self.__sync()
+            days = self.misses.get(source, {})
+            recorded, expires = days.get(self.key(year, day, system), {}).get(station, (0, 0))
+
+        return expires > time.time()
+
+    def station_counts(self, source: str, system: str = "G") -> Dict[str, Tuple[int, int]]:
+        """
+        Return the number of days every station had a file of 'system' and
+        the number of days it was missing one in 'source' (for the misses
+        not expired)
+        """
+        with self.lock:
+            self.__refresh()
+            self.__sync()
+            now = time.time()
+            counts, valid_until = self.counts.get((source, system), (None, 0))
+            if valid_until > now:
+                return counts
+
+            counts = {}
+            valid_until = float("inf")
+            for key, stations in self.files.items():
+                if key.endswith(system):
+                    for station in stations:
+                        hits, misses = counts.get(station, (0, 0))
+                        counts[station] = (hits + 1, misses)
+            for key, stations in self.misses.get(source, {}).items():
+                if key.endswith(system):
+                    for station, (recorded, expires) in stations.items():
+                        if expires > now:
+                            hits, misses = counts.get(station, (0, 0))
+                            counts[station] = (hits, misses + 1)
+                            valid_until = min(valid_until, expires)
+            self.counts[(source, system)] = (counts, valid_until)
+
+        return counts
+
+    @staticmethod
+    def __parse(name: str) -> Tuple[str, int, int, str]:
+        parsed = parse_rinex_name(name)
+        if parsed is None:
+            raise Exception(f"Incorrect Rinex filename format: {name}")
+        return parsed
+
+    def __sync(self):
+        """
+        Add the misses recorded by other processes since the file was last
+        read. The latest record of a file wins, so files found again aren't
+        missing any more.
+        """
+        try:
+            if file_id(os.stat(self.filename)) == self.file_id:
+                return
+        except OSError:
+            return
+
+        catalog = self.__read()
+        if catalog is not None:
+            self.counts = {}
+            for source, days in catalog["misses"].items():
+                for key, stations in days.items():
+                    mine = self.misses.setdefault(source, {}).setdefault(key, {})
+                    for station, record in stations.items():
+                        mine[station] = max(record, mine.get(station, [0, 0]))
+
+    def __read(self) -> dict:
+        try:
+            stat = os.stat(self.filename)
+            with open(self.filename, "r") as file:
+                catalog = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if catalog.get("version") != CATALOG_VERSION or catalog.get("folder") != self.folder:
+            return None
+
+        self.file_id = file_id(stat)
+        return catalog
+
+    def __refresh(self):
+        if os.stat(self.folder).st_mtime_ns != self.mtime_ns:
+            self.__scan()
+
+    def __scan(self):
+        Print("debug0", f"Updating the catalog of {self.folder}")
+
+        # Read before listing, so changes made while listing are seen next time
+        self.mtime_ns = os.stat(self.folder).st_mtime_ns
+
+        self.files = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                parsed = parse_rinex_name(entry.name)
+                if parsed is not None and entry.is_file():
+                    station, year, day, system = parsed
+                    self.files.setdefault(self.key(year, day, system), {})[station] = entry.name
+
+        self.__write()
+
+    def __write(self):
+        # Misses of other processes aren't overwritten. Records are dropped
+        # once any miss recorded before them would have expired.
+        self.__sync()
+        self.counts = {}
+        now = time.time()
+        for days in self.misses.values():
+            for key, stations in days.items():
+                days[key] = {
+                    station: record
+                    for station, record in stations.items()
+                    if record[0] + MISS_TTL > now
+                }
+        self.misses = {
+            source: {key: stations for key, stations in days.items() if stations}
+            for source, days in self.misses.items()
+        }
+        self.misses = {source: days for source, days in self.misses.items() if days}
+
+        catalog = {
+            "version": CATALOG_VERSION,
+            "folder": self.folder,
+            "mtime_ns": self.mtime_ns,
+            "files": self.files,
+            "misses": self.misses,
+        }
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(catalog, file, indent=2, sort_keys=True)
+        os.replace(tmp, self.filename)
+        self.file_id = file_id(os.stat(self.filename))
+
+
+def file_id(stat: os.stat_result) -> Tuple[int, int]:
+    return stat.st_ino, stat.st_mtime_ns
+
+
+_catalog = None
+
+
+def rinex_catalog() -> RinexCatalog:
+    """
+    Return the catalog of RINEX_FOLDER, shared by all the OrbitalData objects
+    """
+    global _catalog
+    if _catalog is None:
+        _catalog = RinexCatalog()
+    return _catalog
+
+
+def test_misses():
+    """
+    Check that misses expire, sooner for recent days, that they are kept per
+    source, and that the records of several processes (catalogs of the same
+    file) are merged, the latest one winning
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "catalog.json")
+        a, b = RinexCatalog(folder, filename), RinexCatalog(folder, filename)
+        source = "http://archive/"
+
+        today = dt.date.today()
+        old = rinex_file_name("ab01", today - dt.timedelta(days=30))
+        recent = rinex_file_name("ab01", today)
+        a.add_miss(old, source)
+        a.add_miss(recent, source)
+
+        def expires(name: str) -> float:
+            station, year, day, system = parse_rinex_name(name)
+            return a.misses[source][RinexCatalog.key(year, day, system)][station][1] - time.time()
+
+        assert MISS_TTL - 60 < expires(old) <= MISS_TTL, "Wrong TTL of an old day"
+        assert (
+            MISS_TTL_RECENT - 60 < expires(recent) <= MISS_TTL_RECENT
+        ), "Wrong TTL of a recent day"
+        assert not a.is_missing(old, "mirror"), "Miss of another source"
+
+        # Misses of one are seen by the other, and kept when the other writes
+        assert b.is_missing(old, source) and b.is_missing(recent, source)
+        other = rinex_file_name("ac70", today - dt.timedelta(days=30))
+        b.add_miss(other, source)
+        a.add_miss(other, "mirror")
+        c = RinexCatalog(folder, filename)
+        assert c.is_missing(old, source) and c.is_missing(other, source)
+        assert c.is_missing(other, "mirror")
+
+        # A file found by one isn't missing for the others, even after they write
+        open(os.path.join(folder, recent), "wb").close()
+        a.add(recent)
+        b.add_miss(other, source)
+        assert not b.is_missing(recent, source), "Miss of a stored file merged back"
+        assert not RinexCatalog(folder, filename).is_missing(recent, source)
+
+        # Records age: expired misses are requested again and dropped from the file
+        with open(filename, "r") as file:
+            catalog = json.load(file)
+        for days in catalog["misses"].values():
+            for stations in days.values():
+                for record in stations.values():
+                    record[0], record[1] = record[0] - MISS_TTL, record[1] - MISS_TTL
+        with open(filename, "w") as file:
+            json.dump(catalog, file)
+        d = RinexCatalog(folder, filename)
+        assert not d.is_missing(old, source) and not d.is_missing(other, "mirror")
+        d.add_miss(recent, source)
+        assert list(RinexCatalog(folder, filename).misses) == [source], "Expired records kept"
+
+    Print("info", "Misses expire, are kept per source and merged between catalogs")
+
+
+if __name__ == "__main__":
+    test_misses()
@@ -1,6 +1,11 @@
 import requests
+import threading
+import os
 
-from random import randint
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+from random import randint, random
+from time import sleep, time
 from json import load
 from pathlib import Path
 from re import search
@@ -25,42 +30,285 @@ from common import RINEX_FOLDER
 # if you want to keep the default name, set the path to a directory. Include a file name to rename.
 token_path = UNAVCO_DIR
 
+# Daily NAV files, in year/day-of-year/ folders
+ARCHIVE_URL = "https://data.unavco.org/archive/gnss/rinex/nav/"
 
-def get_earthscope_rinex(station_rinex_file: str, save_dir: str = RINEX_FOLDER) -> bool:
+# Downloads made at the same time by prefetch_earthscope_rinex()
+PREFETCH_WORKERS = 4
+
+# Attempts per file, and the first wait between them (doubled every time)
+DL_RETRIES = 5
+DL_BACKOFF = 1.0
+DL_TIMEOUT = 30
+DL_CHUNK_SIZE = 1 << 16
+# Server responses worth trying again, and the ones meaning there's no such file
+DL_RETRY_CODES = (408, 425, 429, 500, 502, 503, 504)
+DL_MISSING_CODES = (404, 410)
+LZW_MAGIC = b"\x1f\x9d"
+# Partial files are kept for later runs to resume them, until they are this
+# old (s). Locks of downloads that made no progress for LOCK_STALE seconds
+# were left by killed processes.
+PART_MAX_AGE = 7 * 86400
+LOCK_STALE = 10 * DL_TIMEOUT
+LOCK_POLL = 0.5
+
+# One access token and one keep-alive session for all the downloads
+_token = None
+_session = None
+_pool_size = 0
+_lock = threading.Lock()
+_cleaned = set()  # Folders whose stale partial files were removed
+
+
+def get_token(refresh: bool = False) -> str:
+    """
+    Return the access token, read (or refreshed) from token_path only the first time
+    """
+    global _token
+    with _lock:
+        if _token is None or refresh:
+            # instantiate the device code flow subclass
+            device_flow = DeviceCodeFlowSimple(Path(token_path))
+            try:
+                # get access token from local path
+                device_flow.get_access_token_refresh_if_necessary()
+            except NoTokensError:
+                # if no token was found locally, do the device code flow
+                device_flow.do_flow()
+            _token = device_flow.access_token
+        return _token
+
+
+def get_session(pool_size: int = PREFETCH_WORKERS) -> requests.Session:
+    """
+    Return the session shared by the downloads, with connections for
+    'pool_size' threads to each host
+    """
+    global _session, _pool_size
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _pool_size = pool_size
+        return _session
+
+
+def archive_path(station_rinex_file: str) -> str:
+    """
+    Return the path of a file in the archive (and in its mirrors), year/day/file
+    """
     matches = search(r"(\d\d\d)0\.(\d\d)(n|e|g)\.Z", station_rinex_file)
     assert matches is not None, f"Incorrect Rinex filename format: {station_rinex_file}"
 
-    remote_file_path = "20{1}/{0}/".format(*matches.groups()) + station_rinex_file
-    req_path = "https://data.unavco.org/archive/gnss/rinex/nav/" + remote_file_path
+    return "20{1}/{0}/".format(*matches.groups()) + station_rinex_file
+
+
+def get_earthscope_rinex(
+    station_rinex_file: str,
+    save_dir: str = RINEX_FOLDER,
+    base_url: str = ARCHIVE_URL,
+    auth: bool = True,
+) -> bool:
+    """
+    Download a file from the archive at 'base_url' (or a server laid out like
+    it), with the access token if 'auth'. Returns True if it was downloaded,
+    False if it doesn't exist and None if it couldn't be downloaded (e.g. no
+    network), both falsy.
+    """
+    req_path = base_url + archive_path(station_rinex_file)
 
     save_dir = Path(save_dir)
     station_rinex_file = Path(req_path).name
 
-    # instantiate the device code flow subclass
-    device_flow = DeviceCodeFlowSimple(Path(token_path))
+    # The file is written next to its final name and renamed when complete,
+    # so an interrupted download never looks like a valid file. Only the
+    # process holding the lock writes it.
+    final = Path(save_dir / station_rinex_file)
+    clean_parts(save_dir)
+    lock = lock_download(final)
+    if lock is None:
+        return True  # Downloaded meanwhile by another process
+
     try:
-        # get access token from local path
-        device_flow.get_access_token_refresh_if_necessary()
-    except NoTokensError:
-        # if no token was found locally, do the device code flow
-        device_flow.do_flow()
-    token = device_flow.access_token
-
-    r = requests.get(req_path, headers={"authorization": f"Bearer {token}"})
-    if r.status_code == requests.codes.ok:
-        # save the file
-        with open(Path(save_dir / station_rinex_file), "wb") as f:
-            for data in r:
-                f.write(data)
+        if final.exists():
+            return True
+        return download_file(req_path, final, lock, auth)
+    finally:
+        lock.unlink(missing_ok=True)
+
+
+def download_file(req_path: str, final: Path, lock: Path, auth: bool) -> bool:
+    """
+    Download a file into its partial file, resuming it, and rename it when
+    complete. Returns like get_earthscope_rinex().
+    """
+    station_rinex_file = final.name
+    part = part_path(final)
+
+    for attempt in range(DL_RETRIES):
+        if attempt > 0:
+            delay = DL_BACKOFF * 2 ** (attempt - 1) * (1 + random())
+            print(f"retrying {station_rinex_file} in {delay:.1f}s")
+            sleep(delay)
+
+        # Continue after the bytes already downloaded
+        done = part.stat().st_size if part.exists() else 0
+        headers = {"accept-encoding": "identity"}
+        if auth:
+            headers["authorization"] = f"Bearer {get_token()}"
+        if done > 0:
+            headers["range"] = f"bytes={done}-"
+
+        try:
+            with get_session().get(req_path, headers=headers, stream=True, timeout=DL_TIMEOUT) as r:
+                if r.status_code == requests.codes.unauthorized and auth:
+                    # The token expired since it was read
+                    get_token(refresh=True)
+                    continue
+                if r.status_code == requests.codes.range_not_satisfiable:
+                    # The partial file doesn't match the remote one
+                    part.unlink(missing_ok=True)
+                    continue
+                if r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+                    # problem occured
+                    print(f"failure: {r.status_code}, {r.reason}")
+                    if r.status_code in DL_RETRY_CODES:
+                        continue
+                    return False if r.status_code in DL_MISSING_CODES else None
+
+                if r.status_code == requests.codes.partial_content:
+                    start = search(r"bytes (\d+)-", r.headers.get("content-range", ""))
+                    if start is None or int(start.group(1)) != done:
+                        # Not the rest of the partial file, start again
+                        print(f"failure: {station_rinex_file} resumed at the wrong offset")
+                        part.unlink()
+                        continue
+                    mode = "ab"
+                    total = r.headers.get("content-range", "").rpartition("/")[2]
+                else:
+                    mode = "wb"
+                    total = r.headers.get("content-length", "")
+                total = int(total) if total.isdigit() else None
+
+                with open(part, mode) as f:
+                    for data in r.iter_content(chunk_size=DL_CHUNK_SIZE):
+                        f.write(data)
+                        os.utime(lock)  # Still in progress
+        except (requests.RequestException, OSError) as e:
+            print(f"failure: {e}")
+            continue
+
+        size = part.stat().st_size
+        if total is not None and size < total:
+            print(f"failure: {station_rinex_file} incomplete ({size} of {total} bytes)")
+            continue
+        if (total is not None and size > total) or not is_compressed(part):
+            print(f"failure: {station_rinex_file} is corrupt")
+            part.unlink()
+            continue
+
+        os.replace(part, final)
         return True
-    else:
-        # problem occured
-        print(f"failure: {r.status_code}, {r.reason}")
-        return False
+
+    # The partial file is kept, a later download resumes it
+    print(f"failure: {station_rinex_file} not downloaded after {DL_RETRIES} attempts")
+    return None
+
+
+def part_path(final: Path) -> Path:
+    """
+    Return the name a file is written to before it is complete
+    """
+    return final.with_name(final.name + ".part")
+
+
+def lock_download(final: Path) -> Path:
+    """
+    Take the lock of the download of a file (a file created exclusively),
+    waiting while another process or thread has it. Returns the lock file,
+    None if the file was downloaded meanwhile.
+    """
+    lock = final.with_name(final.name + ".lock")
+    while True:
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return lock
+        except FileExistsError:
+            pass
+
+        if final.exists():
+            return None
+        try:
+            if time() - lock.stat().st_mtime > LOCK_STALE:
+                # Left by a killed process, its partial file is resumed
+                lock.unlink()
+                continue
+        except OSError:
+            continue  # Released meanwhile
+        sleep(LOCK_POLL)
+
+
+def clean_parts(save_dir: Path):
+    """
+    Remove the partial files not resumed for PART_MAX_AGE and the stale
+    locks in a folder, once per folder and process
+    """
+    with _lock:
+        if save_dir in _cleaned:
+            return
+        _cleaned.add(save_dir)
+
+    now = time()
+    for fn in list(save_dir.glob("*.part")) + list(save_dir.glob("*.lock")):
+        try:
+            if fn.suffix == ".lock":
+                stale = now - fn.stat().st_mtime > LOCK_STALE
+            else:
+                locked = fn.with_name(fn.name[: -len(".part")] + ".lock").exists()
+                stale = not locked and now - fn.stat().st_mtime > PART_MAX_AGE
+            if stale:
+                fn.unlink()
+        except OSError:
+            pass
+
+
+def is_compressed(filename: Path) -> bool:
+    """
+    Check that a file starts like a Unix compressed (.Z) file
+    """
+    with open(filename, "rb") as f:
+        return f.read(2) == LZW_MAGIC
+
+
+def prefetch_earthscope_rinex(
+    station_rinex_files: Iterable[str],
+    save_dir: str = RINEX_FOLDER,
+    max_workers: int = PREFETCH_WORKERS,
+    base_url: str = ARCHIVE_URL,
+    auth: bool = True,
+) -> Dict[str, bool]:
+    """
+    Download many files at the same time, with 'max_workers' threads sharing
+    the session and the token. Returns the result of get_earthscope_rinex()
+    for each file.
+    """
+    files = list(dict.fromkeys(station_rinex_files))
+    if not files:
+        return {}
+
+    if auth:
+        get_token()  # Read once before the threads need it
+    get_session(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        done = pool.map(lambda file: get_earthscope_rinex(file, save_dir, base_url, auth), files)
+        return dict(zip(files, done))
 
 
 def get_random_station():
-    ix = randint(0, len(STATIONS))
+    ix = randint(0, len(STATIONS) - 1)  # randint includes the upper bound
     return STATIONS[ix]
 
 
@@ -0,0 +1,209 @@
+import numpy as np
+import datetime as dt
+import csv
+import os
+import tempfile
+
+from typing import Dict, List
+from json import load, dump
+from pathlib import Path
+
+UNAVCO_DIR = Path(__file__).resolve().parent
+
+# Optional metadata of the stations, made with build_stations_meta():
+# {"ab01": {"lat": 54.9, "lon": -162.3, "start": "2004-07-14", "end": null}, ...}
+# with the coordinates in degrees and the dates the station has been operating
+# ("end" null if it still is)
+STATIONS_META_FILE = Path(UNAVCO_DIR / Path("unavco_stations_meta.json"))
+STATIONS_FILE = Path(UNAVCO_DIR / Path("unavco_stations.json"))
+
+# Site list of the UNAVCO GNSS metadata web service (CSV, one row per station)
+# and the names of its columns used for the metadata
+SITES_URL = "https://web-services.unavco.org/gps/metadata/sites/v1"
+SITES_COLUMNS = {
+    "id": "id",
+    "lat": "latitude",
+    "lon": "longitude",
+    "start": "installed",
+    "end": "removed",
+}
+
+
+class StationIndex:
+    def __init__(self, meta: Dict[str, dict]):
+        """
+        Positions and operating dates of the stations in 'meta', to find the
+        nearest ones operating on a day. The stations are few enough
+        (thousands) for a brute force search over all of them.
+        """
+        self.names = list(meta.keys())
+
+        lat = np.radians([meta[s]["lat"] for s in self.names])
+        lon = np.radians([meta[s]["lon"] for s in self.names])
+        self.xyz = unit_vector(lat, lon)
+
+        self.start = np.array([meta[s].get("start") or "NaT" for s in self.names], "datetime64[D]")
+        self.end = np.array([meta[s].get("end") or "NaT" for s in self.names], "datetime64[D]")
+
+    @staticmethod
+    def load(filename: str = STATIONS_META_FILE) -> "StationIndex":
+        """
+        Return the index of the stations in the metadata file, None if it doesn't exist
+        """
+        if not Path(filename).is_file():
+            return None
+        with open(filename, "r") as file:
+            return StationIndex(load(file))
+
+    def nearest(self, lat: float, lon: float, day: dt.date, k: int = 10) -> List[str]:
+        """
+        Return the 'k' stations nearest to the coordinates (degrees) that
+        were operating on 'day', the nearest first
+        """
+        day = np.datetime64(day, "D")
+        operating = ~(self.start > day) & ~(self.end < day)  # Comparisons with NaT are False
+
+        # The largest cosine of the central angle is the shortest distance
+        cos = self.xyz @ unit_vector(np.radians(lat), np.radians(lon))
+        cos[~operating] = -np.inf
+
+        k = min(k, int(operating.sum()))
+        best = np.argpartition(-cos, k - 1)[:k] if k > 0 else []
+        return [self.names[i] for i in sorted(best, key=lambda i: -cos[i])]
+
+    def distance(self, station: str, lat: float, lon: float) -> float:
+        """
+        Return the great circle distance (km) from a station to the coordinates
+        """
+        cos = self.xyz[self.names.index(station)] @ unit_vector(np.radians(lat), np.radians(lon))
+        return 6371.0 * np.arccos(np.clip(cos, -1, 1))
+
+
+def unit_vector(lat, lon) -> np.ndarray:
+    """
+    Return the unit vectors (..., 3) of the directions of spherical coordinates (radians)
+    """
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def build_stations_meta(
+    source: str = SITES_URL,
+    filename: str = STATIONS_META_FILE,
+    columns: Dict[str, str] = SITES_COLUMNS,
+) -> int:
+    """
+    Make the metadata file from a site list, a CSV file or URL with the
+    columns named in 'columns' (lines starting with '#' are skipped). Only
+    the stations of the archive (STATIONS_FILE) are kept. Returns the number
+    of stations stored.
+    """
+    if str(source).startswith(("http://", "https://")):
+        import requests
+
+        reply = requests.get(source, timeout=60)
+        reply.raise_for_status()
+        lines = reply.text.splitlines()
+    else:
+        with open(source, "r") as file:
+            lines = file.read().splitlines()
+
+    with open(STATIONS_FILE, "r") as file:
+        archive = set(load(file))
+
+    rows = csv.DictReader(line for line in lines if line.strip() and not line.startswith("#"))
+    meta = {}
+    for row in rows:
+        row = {key.strip().lower(): (value or "").strip() for key, value in row.items() if key}
+        station = row.get(columns["id"], "").lower()
+        if station not in archive:
+            continue
+        try:
+            lat, lon = float(row[columns["lat"]]), float(row[columns["lon"]])
+        except (KeyError, ValueError):
+            continue
+        # Only the date of date-times
+        start = row.get(columns["start"], "")[:10] or None
+        end = row.get(columns["end"], "")[:10] or None
+        meta[station] = {"lat": lat, "lon": lon, "start": start, "end": end}
+
+    if not meta:
+        raise Exception(f"No stations of the archive found in {source}")
+
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "w") as file:
+        dump(meta, file, indent=2, sort_keys=True)
+    os.replace(tmp, filename)
+
+    # Read again when needed
+    global _index_loaded
+    _index_loaded = False
+
+    return len(meta)
+
+
+_index = None
+_index_loaded = False
+
+
+def station_index() -> StationIndex:
+    """
+    Return the index of STATIONS_META_FILE (loaded once), None if there's no metadata
+    """
+    global _index, _index_loaded
+    if not _index_loaded:
+        _index = StationIndex.load()
+        _index_loaded = True
+    return _index
+
+
+def test_stations():
+    """
+    Check the order of the nearest stations, that only the stations operating
+    on the day are found, and the metadata made from a small site list
+    """
+    meta = {
+        "ab01": {"lat": 60.0, "lon": 24.0, "start": "2004-01-01", "end": None},
+        "ab02": {"lat": 61.0, "lon": 24.0, "start": "2004-01-01", "end": None},
+        "ab04": {"lat": 62.0, "lon": 24.0, "start": "2004-01-01", "end": "2010-12-31"},
+        "ab06": {"lat": 63.0, "lon": 24.0, "start": None, "end": None},
+    }
+    index = StationIndex(meta)
+    day = dt.date(2019, 7, 4)
+
+    # ab04 was removed before the day
+    assert index.nearest(62.1, 24.0, day, k=3) == ["ab06", "ab02", "ab01"]
+    assert index.nearest(62.1, 24.0, dt.date(2009, 1, 1), k=2) == ["ab04", "ab06"]
+    assert index.nearest(0.0, 0.0, day, k=10) == ["ab01", "ab02", "ab06"]
+    assert index.nearest(62.1, 24.0, dt.date(2000, 1, 1), k=3) == ["ab06"]
+    # One degree of latitude
+    assert abs(index.distance("ab01", 61.0, 24.0) - 111.2) < 0.1
+
+    with tempfile.TemporaryDirectory() as folder:
+        sites = Path(folder) / "sites.csv"
+        sites.write_text(
+            "# Site list\n"
+            "ID,Name,Latitude,Longitude,Installed,Removed\n"
+            "AB01,first,60.0,24.0,2004-01-01T00:00:00,\n"
+            "ZZ99,not in the archive,61.0,24.0,2004-01-01T00:00:00,\n"
+            "AB02,no coordinates,,,2004-01-01T00:00:00,\n"
+            "AB04,removed,62.0,24.0,2004-01-01T00:00:00,2010-12-31T00:00:00\n"
+        )
+        filename = Path(folder) / "meta.json"
+        assert build_stations_meta(sites, filename) == 2
+        loaded = StationIndex.load(filename)
+        assert loaded.names == ["ab01", "ab04"]
+        assert loaded.nearest(62.1, 24.0, day) == ["ab01"]
+
+    print("test_stations passed")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["test"]:
+        # python stations.py test
+        test_stations()
+    else:
+        # python stations.py [site list file or URL]
+        count = build_stations_meta(*sys.argv[1:2])
+        print(f"Metadata of {count} stations stored in {STATIONS_META_FILE}")